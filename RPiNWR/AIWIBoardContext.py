@@ -46,6 +46,9 @@ class AIWIBoardContext(Context):
 
     relay_gpio_pins = [13, 19]
 
+    interrupt_gpio_pin = 23  # The Si4707 pulls this down to signal an interrupt
+    has_interrupt_line = True
+
     i2c = Adafruit_GPIO.I2C.get_i2c_device(0x11)
 
     def __init__(self):
@@ -67,8 +70,8 @@ class AIWIBoardContext(Context):
         sleep(0.4)
         gpio.output(17, gpio.HIGH)
 
-        gpio.setup(23, gpio.IN, pull_up_down=gpio.PUD_UP)
-        gpio.add_event_detect(23, gpio.FALLING)
+        gpio.setup(self.interrupt_gpio_pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        gpio.add_event_detect(self.interrupt_gpio_pin, gpio.FALLING, callback=self.__on_interrupt)
 
         # Initialize the onboard relays
         for pin in self.relay_gpio_pins:
@@ -85,6 +88,10 @@ class AIWIBoardContext(Context):
 
         sleep(1.5)
 
+    def __on_interrupt(self, channel):
+        # Called from the GPIO library's thread
+        self.interrupt()
+
     def write_bytes(self, data):
         # TODO make this accept bytes(...)
         if len(data) == 1:
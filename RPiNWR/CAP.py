@@ -20,7 +20,8 @@ import re
 import iso8601
 from RPiNWR.VTEC import VTEC
 from RPiNWR.CommonMessage import CommonMessage
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, Point
+from shapely.prepared import prep
 import time
 
 
@@ -44,6 +45,7 @@ class CAPMessage(CommonMessage):
 
         if self.FIPS6:
             self.FIPS6 = re.sub("[\n\t ] +", " ", self.FIPS6.strip()).split(" ")
+            self.__index_fips()
 
         if self.polygon is not None and len(self.polygon.strip()) > 0:
             self.polygon = re.sub("[\n\t ] +", " ", self.polygon)
@@ -51,6 +53,9 @@ class CAPMessage(CommonMessage):
         else:
             self.polygon = None
 
+        self.__parse_vtec(dom)
+
+    def __parse_vtec(self, dom):
         try:
             if self.__dict__['VTEC'] and len(self.VTEC):
                 self.vtec = VTEC.VTEC(self.VTEC, self)
@@ -61,6 +66,30 @@ class CAPMessage(CommonMessage):
         except KeyError:
             self.vtec = (NOVTEC(dom, self),)
 
+    def to_dict(self):
+        """
+        :return: the parsed fields of the message, as simple types (for JSON), from which from_dict can remake it
+        """
+        d = dict([(k, v) for k, v in self.__dict__.items() if not k.startswith("_CAPMessage__") and k != "vtec"])
+        if self.polygon is not None:
+            d["polygon"] = list([list(x) for x in self.polygon.exterior.coords])
+        return d
+
+    @staticmethod
+    def from_dict(d):
+        """
+        :param d: as from to_dict
+        :return: the CAPMessage, remade without parsing any XML
+        """
+        msg = CAPMessage.__new__(CAPMessage)
+        msg.__dict__.update(d)
+        if msg.polygon is not None:
+            msg.polygon = Polygon([tuple(x) for x in msg.polygon])
+        if msg.FIPS6:
+            msg.__index_fips()
+        msg.__parse_vtec(None)
+        return msg
+
     @staticmethod
     def __parse_date_or_text(str):
         try:
@@ -92,15 +121,68 @@ class CAPMessage(CommonMessage):
         return self.FIPS6
 
     def applies_to_fips(self, fips):
+        """
+        :param fips: A FIPS code, with a leading P component (0 for the whole county) to indicate a subset of it
+        :return: True if the message names the county or that part of it, or the whole county, or (for a whole
+           county) any part of it
+        """
         if not self.FIPS6:
             return False
+        try:
+            codes, counties = self.__fips
+        except AttributeError:  # Unpickled from before these were kept
+            codes, counties = self.__index_fips()
         if fips.startswith('0'):
-            fips = '.' + fips[1:]
-        else:
-            fips = '[0' + fips[0] + ']' + fips[1:]
-        fips = '^' + fips + '$'
-        fp = re.compile(fips)
-        return len(list(filter(lambda c: fp.match(c), self.FIPS6))) > 0
+            return fips[1:] in counties
+        return fips in codes or '0' + fips[1:] in codes
+
+    def __index_fips(self):
+        """
+        Keep the FIPS codes as a set, along with the set of counties (codes without their P component), so that
+        applies_to_fips needn't look through them.
+        """
+        self.__fips = (frozenset(self.FIPS6), frozenset([c[1:] for c in self.FIPS6 if len(c)]))
+        return self.__fips
+
+    def get_prepared_polygon(self):
+        """
+        :return: the polygon, prepared for repeated containment tests, or None if there is no polygon
+        """
+        if self.polygon is None:
+            return None
+        try:
+            return self.__prepared
+        except AttributeError:
+            self.__prepared = prep(self.polygon)
+            return self.__prepared
+
+    def polygon_contains(self, latlon):
+        """
+        :param latlon: a tuple of latitude and longitude
+        :return: True if the polygon contains the point, False if not or if there is no polygon.  The answer is
+           remembered, since neither the polygon nor (usually) the point of interest changes.
+        """
+        try:
+            contains = self.__contains
+        except AttributeError:
+            contains = self.__contains = {}
+        latlon = tuple(latlon)
+        try:
+            return contains[latlon]
+        except KeyError:
+            polygon = self.get_prepared_polygon()
+            result = contains[latlon] = polygon is not None and polygon.contains(Point(*latlon))
+            return result
+
+    def _fields_to_skip_for_eq(self):
+        return set(["_CAPMessage__fips", "_CAPMessage__prepared", "_CAPMessage__contains"])
+
+    def __getstate__(self):
+        # Prepared geometries can't be pickled, and they're quick enough to remake
+        state = dict(self.__dict__)
+        state.pop("_CAPMessage__prepared", None)
+        state.pop("_CAPMessage__contains", None)
+        return state
 
 
 class NOVTEC(VTEC):
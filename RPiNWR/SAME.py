@@ -22,13 +22,21 @@ import time
 import logging
 import threading
 import functools
+import bisect
 import calendar
+import collections
+import array
+import numpy
 from RPiNWR.nwr_data import *
 from RPiNWR.CommonMessage import CommonMessage
+from RPiNWR.metrics import Metrics, SIZE_BUCKETS
 
 # See http://www.nws.noaa.gov/directives/sym/pd01017012curr.pdf
 # also https://www.gpo.gov/fdsys/pkg/CFR-2010-title47-vol1/xml/CFR-2010-title47-vol1-sec11-31.xml
 
+# To turn confidences 0-3 from bytes into their digits
+_CONFIDENCE_DIGITS = bytes([(i + ord('0')) & 0xFF for i in range(256)])
+
 _ORIGINATORS = [
     ("Broadcast station or cable system", "EAS"),
     ("Civil authorities", "CIV"),
@@ -114,20 +122,34 @@ def _reconcile_character(bitstrue, bitsfalse, pattern):
     if sum(bitstrue) == 0 and len(pattern) > 1:  # only nulls received, more than 1 possibility
         #returns a ⨀
         return 0, chr(0)
-    near = []
-    for t in list(pattern):
-        distance = 0
-        for j in range(0, 8):
-            bit_weight = bitstrue[j] - bitsfalse[j]
-            if ((ord(t) >> j) & 1) != (bit_weight > 0) & 1:
-                distance += abs(bit_weight)
-        near.append((distance, t))
-    near.sort()
-    if len(near) == 1 or near[0][0] != near[1][0]:
+    chars, bits = _character_class(pattern)
+    bit_weight = numpy.asarray(bitstrue) - numpy.asarray(bitsfalse)
+    # Each bit that disagrees with the vote costs the weight of that bit, so the weighted Hamming distance
+    # to every candidate comes out of a single product with the candidates' bits.
+    distance = numpy.maximum(bit_weight, 0).sum() - bits.dot(bit_weight)
+    best = int(distance.argmin())  # candidates are sorted, so ties go to the lowest character
+    if len(chars) == 1 or numpy.count_nonzero(distance == distance[best]) == 1:
         confidence = 2
     else:
         confidence = 1
-    return confidence, near[0][1]
+    return confidence, chars[best]
+
+
+_CHARACTER_CLASSES = {}
+
+
+def _character_class(pattern):
+    """
+    :param pattern: A string containing all the possible characters for a spot
+    :return: a tuple of the sorted characters and a (characters x 8) array of their bits, LSB first
+    """
+    try:
+        return _CHARACTER_CLASSES[pattern]
+    except KeyError:
+        chars = sorted(pattern)
+        bits = (numpy.array([ord(c) for c in chars])[:, numpy.newaxis] >> numpy.arange(8)) & 1
+        _CHARACTER_CLASSES[pattern] = chars, bits
+        return chars, bits
 
 # -WXR-TOR-039173-039051-139069+0030-1591829-KCLE/NWS
 __ALPHA = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
@@ -141,6 +163,49 @@ __SAME_CHARS = [
     __ALPHA, __ALPHA, __ALPHA, __ALPHA, '/', 'N', 'W', 'S', '-'
 ]
 
+# Prepare the character classes for every spot in the message, including the combined classes where the pattern
+# can repeat, so that reconciling characters doesn't have to work them out each time.
+for __i in range(0, len(__SAME_CHARS)):
+    if type(__SAME_CHARS[__i]) is int:
+        _character_class(__SAME_CHARS[__i + __SAME_CHARS[__i]] + __SAME_CHARS[__i + 1])
+    else:
+        _character_class(__SAME_CHARS[__i])
+del __i
+
+
+SAMEFields = collections.namedtuple("SAMEFields", ["originator", "event", "fips", "duration_str", "duration_sec",
+                                                   "start_time_str", "start_time_sec", "callsign"])
+
+
+def _parse_fields(message, received):
+    """
+    Split a SAME message into its fields.
+
+    :param message: the SAME message
+    :param received: the time the message was received (seconds since the epoch), to work out the year of issue
+    :return: SAMEFields for the message, with None for the seconds if they can't be parsed
+    """
+    plus = message.find('+')
+    duration_str = message[plus + 1:plus + 5]
+    start_time_str = message[plus + 6:plus + 13]
+    try:
+        duration_sec = int(duration_str[0:2]) * 60 * 60 + int(duration_str[2:4]) * 60
+    except ValueError:
+        duration_sec = None
+    try:
+        now = time.gmtime(received)
+        year = now.tm_year
+        issue_jday = int(start_time_str[0:3])
+        if now.tm_yday < 10 and issue_jday > 355:
+            year -= 1
+        elif now.tm_yday > 355 and issue_jday < 10:
+            year += 1
+        start_time_sec = calendar.timegm(time.strptime(str(year) + start_time_str + 'UTC', '%Y%j%H%M%Z'))
+    except ValueError:
+        start_time_sec = None
+    return SAMEFields(message[1:4], message[5:8], tuple(message[9:plus].split("-")), duration_str, duration_sec,
+                      start_time_str, start_time_sec, message[plus + 14:-1])
+
 
 class SAMEMessage(CommonMessage):
     """
@@ -157,19 +222,25 @@ class SAMEMessage(CommonMessage):
 
     def __init__(self, transmitter, headers=None, received_callback=None):
         """
-        :param transmitter: Call letters for the transmitter, so that FIPS codes can be checked.
+        :param transmitter: The DecodeProfile of the transmitter, so that FIPS codes can be checked, or its call
+           letters (to look up the profile).
         :param headers:  Headers for a legacy message to reconstitute, None if this is a new message,
            and a string if it's just for parsing.
         :param received_callback: A callable taking one parameter, this SAMEMessage, to be called once, on the
            occasion that this message is first fully received
         :return:
         """
-        if transmitter is not None and transmitter[0] == '-':
+        if hasattr(transmitter, 'lower') and transmitter[0] == '-':
             headers = transmitter
             transmitter = None
 
-        self.transmitter = transmitter
+        self.__profile = get_decode_profile(transmitter)
+        self.transmitter = self.__profile.transmitter
         self.__avg_message = None
+        self.__votes = None  # running tally of bitstrue & bitsfalse over the headers received so far
+        self.__provisional = None  # decode of the headers received so far, before the message is complete
+        self.__fields = None  # SAMEFields, once the message is complete
+        self.__lock = threading.RLock()  # for the headers and their decodes, added & read on different threads
         self.received_callback = received_callback
         self.timeout = 0
         event_id = None
@@ -183,6 +254,8 @@ class SAMEMessage(CommonMessage):
                 event_id = self.__avg_message
             else:
                 self.headers = headers
+                for header in headers:
+                    self.__tally(header)
                 self.start_time = headers[0][2]
                 self.timeout = self.start_time + 6
         else:
@@ -196,15 +269,41 @@ class SAMEMessage(CommonMessage):
         self.event_id = event_id
 
     def add_header(self, header, confidence):
+        """
+        :param header: the header as received, a string or bytes
+        :param confidence: the confidence (0-3) of each character, a string of digits, a list, or bytes
+        """
         if self.fully_received():
             raise ValueError("Message is already complete.")
         when = time.time()
-        try:
-            confidence[0] + 'a'
-        except TypeError:
-            confidence = "".join([str(x) for x in confidence])
-        self.headers.append((_unicodify(header), confidence, when))
-        self.timeout = when + 6
+        if isinstance(header, (bytes, bytearray)):
+            header = header.decode('latin-1')
+        if isinstance(confidence, (bytes, bytearray, array.array)):
+            confidence = bytes(confidence).translate(_CONFIDENCE_DIGITS).decode('ascii')
+        else:
+            try:
+                confidence[0] + 'a'
+            except TypeError:
+                confidence = "".join([str(x) for x in confidence])
+        header = (_unicodify(header), confidence, when)
+        with self.__lock:
+            self.headers.append(header)
+            self.__tally(header)
+            self.timeout = when + 6
+
+    def __tally(self, header):
+        """
+        Fold the bit votes of one more header into the running tally, so that decoding needn't start over.  Outside
+        the constructor, hold the lock, so that no decode sees the header without its votes.
+        """
+        votes = numpy.array(_vote_bits([header]))
+        if self.__votes is None:
+            self.__votes = votes
+        else:
+            if votes.shape[1] > self.__votes.shape[1]:
+                self.__votes, votes = votes, self.__votes
+            self.__votes[:, 0:votes.shape[1]] += votes
+        self.__provisional = None
 
     def get_areas(self):
         return self.get_counties()
@@ -227,52 +326,77 @@ class SAMEMessage(CommonMessage):
         return complete
 
     def get_SAME_message(self):
-        if self.fully_received():
-            if self.__avg_message is None:
-                self.__avg_message = average_message(self.headers, self.transmitter)
-                mtype = self.get_event_type()
-                level = default_prioritization(mtype)
-                logging.getLogger("RPiNWR.same.message.%s.%s" % (self.get_originator(), mtype)).log(level, "%s", self)
-            return self.__avg_message
-        else:
-            if len(self.headers) > 0:
-                return average_message(self.headers)
+        """
+        :return: a tuple of the message and the confidence of each character.  Until the message is fully received,
+           this is a provisional decode of the headers so far, refined as each header arrives.
+        """
+        complete = self.fully_received()
+        with self.__lock:
+            if complete:
+                if self.__avg_message is None:
+                    self.__avg_message, how = self.__average()
+                    _count_decode(how)
+                    mtype = self.get_event_type()
+                    level = default_prioritization(mtype)
+                    logging.getLogger("RPiNWR.same.message.%s.%s" % (self.get_originator(), mtype)).log(
+                        level, "%s", self)
+                return self.__avg_message
+            elif len(self.headers) > 0:
+                if self.__provisional is None:
+                    self.__provisional = self.__average()[0]
+                return self.__provisional
             else:
                 return "", []
 
+    def __average(self):
+        """
+        :return: the decode of the headers so far, as for average_message, and how it was decoded, as for
+           DECODE_COUNTS
+        """
+        exact = _exact_match(self.headers)
+        if exact:
+            return exact, "exact"
+        return _average_votes(self.__votes[0], self.__votes[1], self.__profile, self.headers[0][2]), "reconciled"
+
+    def get_fields(self):
+        """
+        :return: SAMEFields parsed from the message.  They are parsed once the message is fully received, and each
+           time they're asked for before then.
+        """
+        fields = self.__fields
+        if fields is None:
+            complete = self.fully_received()
+            fields = _parse_fields(self.get_SAME_message()[0], self.start_time)
+            if complete:
+                self.__fields = fields
+        return fields
+
     def get_originator(self):
-        return self.get_SAME_message()[0][1:4]
+        return self.get_fields().originator
 
     def get_event_type(self):
-        return self.get_SAME_message()[0][5:8]
+        return self.get_fields().event
 
     def get_counties(self):
-        m = self.get_SAME_message()[0]
-        return m[9:m.find('+')].split("-")
+        return list(self.get_fields().fips)
 
     def get_duration_str(self):
-        m = self.get_SAME_message()[0]
-        start = m.find('+') + 1
-        return m[start:start + 4]
+        return self.get_fields().duration_str
 
     def get_start_time_str(self):
-        m = self.get_SAME_message()[0]
-        start = m.find('+') + 6
-        return m[start:start + 7]
+        return self.get_fields().start_time_str
 
     def get_duration_sec(self):
-        d_str = self.get_duration_str()
-        return int(d_str[0:2]) * 60 * 60 + int(d_str[2:4]) * 60
+        fields = self.get_fields()
+        if fields.duration_sec is None:
+            raise ValueError("Invalid duration %s" % fields.duration_str)
+        return fields.duration_sec
 
     def get_start_time_sec(self):
-        now = time.gmtime(self.start_time)
-        year = now.tm_year
-        issue_jday = int(self.get_start_time_str()[0:3])
-        if now.tm_yday < 10 and issue_jday > 355:
-            year -= 1
-        elif now.tm_yday > 355 and issue_jday < 10:
-            year += 1
-        return calendar.timegm(time.strptime(str(year) + self.get_start_time_str() + 'UTC', '%Y%j%H%M%Z'))
+        fields = self.get_fields()
+        if fields.start_time_sec is None:
+            raise ValueError("Invalid start time %s" % fields.start_time_str)
+        return fields.start_time_sec
 
     def get_end_time_sec(self):
         return self.get_start_time_sec() + self.get_duration_sec()
@@ -289,37 +413,75 @@ class SAMEMessage(CommonMessage):
             raise ValueError()
 
         # TODO identify an uncertain match (i.e. there was ambiguity in the counties received)
-        msg, confidence = self.get_SAME_message()
-        for i in range(15, len(msg) - 20, 7):
-            match = True
-            for x in range(-1, -6, -1):
-                match &= msg[i + x] == fips[x]
-                if not match:
-                    break
-            match &= fips[0] == '0' or msg[i - 6] == '0' or fips[0] == msg[i - 6]
-            if match:
+        for county in self.get_fields().fips:
+            if len(county) == 6 and county[1:] == fips[1:] and (
+                            fips[0] == '0' or county[0] == '0' or fips[0] == county[0]):
                 return True
 
         return False
 
     def get_broadcaster(self):
-        m = self.get_SAME_message()[0]
-        start = m.find('+') + 14
-        return m[start:-1]
+        return self.get_fields().callsign
 
     def __str__(self):
         msg = self.get_SAME_message()
         return 'SAMEMessage: { "message":"%s", "confidence":"%s" }' % (
             _unicodify(msg[0]), "".join([str(x) for x in msg[1]]))
 
+    def _fields_to_skip_for_eq(self):
+        return set(["_SAMEMessage__votes", "_SAMEMessage__provisional", "_SAMEMessage__fields",
+                    "_SAMEMessage__profile", "_SAMEMessage__lock"])
+
+    def __getstate__(self):
+        # Locks can't be pickled
+        state = dict(self.__dict__)
+        del state["_SAMEMessage__lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.RLock()
+
     def to_dict(self):
+        fields = self.get_fields()
         return {
             "message": self.get_SAME_message()[0],
             'confidence': self.get_SAME_message()[1],
             'headers': self.headers,
-            "time": self.start_time
+            "time": self.start_time,
+            "transmitter": self.transmitter,
+            "timeout": self.timeout if self.timeout != float("-inf") else None,
+            "event_id": self.event_id,
+            "fields": list(fields)
         }
 
+    @staticmethod
+    def from_dict(d):
+        """
+        :param d: as from to_dict, perhaps by way of JSON
+        :return: the fully received SAMEMessage, remade without decoding its headers again
+        """
+        msg = SAMEMessage(d.get("transmitter"))
+        if d["headers"] is None:
+            msg.headers = None
+        else:
+            msg.headers = list([tuple(h) for h in d["headers"]])
+        msg.__avg_message = (d["message"], d["confidence"])
+        msg.start_time = msg.published = d["time"]
+        msg.timeout = d.get("timeout")
+        if msg.timeout is None:
+            msg.timeout = float("-inf")
+        event_id = d.get("event_id")
+        if event_id is not None:
+            msg.event_id = tuple(event_id) if isinstance(event_id, list) else event_id
+        else:
+            msg.event_id = "%s-%.3f" % (msg.transmitter, msg.start_time)
+        if d.get("fields") is not None:
+            fields = list(d["fields"])
+            fields[2] = tuple(fields[2])
+            msg.__fields = SAMEFields(*fields)
+        return msg
+
 # split message into component parts according to SAME protocol
 # EXAMPLE:
 # format: -<Originator>-<Event>-<Locations>-<Purge Time>-<Timestamp>-<Call Sign>
@@ -405,29 +567,32 @@ def split_message(message, confidences):
     return [final_message, final_confidences]
 
 
-# takes headers and computes sums of confidence of bit values
-# TODO: rename this
-def sum_confidence(bitstrue, bitsfalse, headers):
-    for (msg, c, when) in headers:
-        # convert to int if c is a string
+def _vote_bits(headers):
+    """
+    Tally the votes of all the headers for every bit of every byte, weighted by confidence.
+
+    :param headers: as for average_message
+    :return: a tuple of numpy arrays (bitstrue, bitsfalse), each shaped (bytes, 8) with the LSB first, holding the
+       summed confidence favoring each bit being true or false, respectively
+    """
+    size = max([len(x[0]) for x in headers])
+    # (headers x bytes) arrays of the characters and the confidence of each character
+    chars = numpy.zeros((len(headers), size), dtype=numpy.uint32)
+    weights = numpy.zeros((len(headers), size), dtype=numpy.int64)
+    for h, (msg, c, when) in enumerate(headers):
+        chars[h, 0:len(msg)] = numpy.frombuffer(msg.encode('utf-32-le'), dtype=numpy.uint32)
         if type(c) is str:
-            confidence = [int(x) for x in c]
-        # otherwise leave it as a list of ints
-        else:
-            confidence = c
-        # Loop through the characters of the message
-        for i in range(0, len(msg)):
-            if ord(msg[i]):  # null characters don't count b/c they indicate no data, not all 0 bits
-                # Loop through bits and apply confidence for true or false
-                for j in range(0, 8):
-                    # if the last bit (e.g. 00001) is a 1:
-                    if (ord(msg[i]) >> j) & 1:
-                        # then add it to the bitstrue (or bitsfalse) bits with that bit's confidence level
-                        bitstrue[(i << 3) + j] += 1 * confidence[i]
-                    else:
-                        bitsfalse[(i << 3) + j] += 1 * confidence[i]
-    # return 1 if successful
-    return 1
+            c = numpy.frombuffer(c.encode('ascii'), dtype=numpy.uint8) - ord('0')
+        c = numpy.asarray(c)[0:len(msg)]
+        weights[h, 0:len(c)] = c
+    # null characters don't count b/c they indicate no data, not all 0 bits
+    weights[chars == 0] = 0
+
+    # (headers x bytes x 8) array of bits, LSB first
+    bits = ((chars[:, :, numpy.newaxis] >> numpy.arange(8, dtype=numpy.uint32)) & 1).astype(numpy.uint8)
+    bitstrue = numpy.einsum('hn,hnb->nb', weights, bits)
+    bitsfalse = weights.sum(axis=0)[:, numpy.newaxis] - bitstrue
+    return bitstrue, bitsfalse
 
 
 # faux-mutates a string by transforming it into a list, making changes, and casting it back to a string
@@ -451,6 +616,7 @@ def average_message(headers, transmitter):
 
     :param headers: an array of tuples, each containing a string message and an array (or string) of confidence values.
        The complete message is assumed to be as long as the longest message, and messages align at the start.
+    :param transmitter: the DecodeProfile of the transmitter, or its call letters
     :return: a tuple containing a single string corresponding to the most certain available data, and
              the combined confidence for each character (range 1-9)
     """
@@ -462,10 +628,6 @@ def average_message(headers, transmitter):
     # 5. Check that characters are in the valid set for the section of the message
     # 6. Substitute any low-confidence data with data from the list of possible values
     # TODO factor this into different functions to do the work and test them separately
-    size = max([len(x[0]) for x in headers])
-    bitstrue = [0] * 8 * size
-    bitsfalse = [0] * 8 * size
-    confidences = [0] * size
 
     # final message to return
     final_msg = ''
@@ -474,27 +636,64 @@ def average_message(headers, transmitter):
     # for (msg, c, when) in headers:
     #   msg = split_message(msg, c)
 
+    # Clean headers need none of that
+    exact = _exact_match(headers)
+    if exact:
+        _count_decode("exact")
+        return exact
+
     # First look through the messages and compute sums of confidence of bit values
+    bitstrue, bitsfalse = _vote_bits(headers)
+    _count_decode("reconciled")
+    return _average_votes(bitstrue, bitsfalse, get_decode_profile(transmitter), headers[0][2])
+
+
+# How many messages were decoded each way: "exact" when clean headers matched, "reconciled" otherwise.  A
+# SAMEMessage counts once, when it's complete, however many provisional decodes it made on the way.
+DECODE_COUNTS = collections.Counter()
+_decode_counts_lock = threading.Lock()
+
+
+def _count_decode(how):
+    with _decode_counts_lock:
+        DECODE_COUNTS[how] += 1
 
-    sum_confidence(bitstrue, bitsfalse, headers)
 
+def _exact_match(headers):
+    """
+    :param headers: as for average_message
+    :return: the message with full confidence, as for average_message, if at least two headers are the same complete
+       and valid SAME message (ignoring anything received after its end), otherwise None
+    """
+    seen = set()
+    for header in headers:
+        m = SAME_PATTERN.match(header[0])
+        if m and m.group(0)[-1] == '-':
+            msg = m.group(0)
+            if msg in seen:
+                return _unicodify(msg), [9] * len(msg)
+            seen.add(msg)
+    return None
+
+
+def _average_votes(bitstrue, bitsfalse, profile, when):
+    """
+    Finish the work of average_message once the votes for each bit have been tallied.
+
+    :param bitstrue: weights favoring each bit being true, shaped (bytes, 8) as from _vote_bits
+    :param bitsfalse: weights favoring each bit being false, likewise
+    :param profile: the DecodeProfile of the transmitter, so that FIPS codes can be checked
+    :param when: the time the first header was received, to check the issue time against
+    :return: as for average_message
+    """
     # Then combine that information into a single aggregate message
-    avgmsg = []
+    bit_weight = bitstrue - bitsfalse
+    chars = numpy.packbits((bit_weight > 0)[:, ::-1], axis=1)[:, 0]  # the bits are voted least significant first
+    confidences = numpy.abs(bit_weight).sum(axis=1)
+    confidences[chars == 0] = 0
+    avgmsg = [chr(c) for c in chars.tolist()]
+    confidences = confidences.tolist()
     byte_pattern_index = 0
-    for i in range(0, size):
-        # Assemble a character from the various bits
-        c = 0
-        confidences[i] = 0
-        for j in range(0, 8):
-            bit_weight = (bitstrue[(i << 3) + j] - bitsfalse[(i << 3) + j])
-            c |= (bit_weight > 0) << j
-            confidences[i] += abs(bit_weight)
-            print(bit_weight)
-            print(confidences[i])
-            print(chr(c))
-        if c == 0:
-            confidences[i] = 0
-        avgmsg.append(chr(c))
 
     # Figure out the length
     avgmsg, confidences = _truncate(avgmsg, confidences)
@@ -514,8 +713,7 @@ def average_message(headers, transmitter):
                     byte_pattern_index + 1]
             if c not in pattern:
                 # That was ugly.  Now find the closest legitimate character
-                byte_confidence, c = _reconcile_character(bitstrue[i * 8:(i + 1) * 8], bitsfalse[i * 8:(i + 1) * 8],
-                                                          pattern)
+                byte_confidence, c = _reconcile_character(bitstrue[i], bitsfalse[i], pattern)
                 byte_confidence <<= 3  # It will get shifted back in a moment
             if not multipath:
                 byte_pattern_index += 1
@@ -530,34 +728,28 @@ def average_message(headers, transmitter):
     avgmsg = "".join(avgmsg)
 
     # Now break the message into its parts and clean up each one
-    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, 1, _ORIGINATOR_CODES)
-    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, 5, _EVENT_CODES)
+    median = __median(confidences)
+    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, 1, _ORIGINATOR_INDEX, median)
+    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, 5, _EVENT_INDEX, median)
 
     # Reconcile FIPS codes (which, in some non-weather types of messages, may not be FIPS)
-    try:
-        candidate_fips = list(get_counties(transmitter))
-    except KeyError:
-        candidate_fips = []
-
-    try:
-        wfo = [get_wfo(transmitter)]
-    except KeyError:
-        wfo = []
+    matched_fips = collections.Counter()  # Each county is matched only once
+    matched_suffixes = collections.Counter()
 
     def check_fips(avgmsg, confidences, ixlist):
         recheck = []
         matched1 = False
         for ix in ixlist:
-            avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix - 1, ['-'])
-            avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix,
-                                                           [(1.1, '0'), (1, '1'), (1, '2'), (1, '3'), (1, '4'),
-                                                            (1, '5'), (1, '6'), (1, '7'), (1, '8'), (1, '9')])
-            avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix + 1,
-                                                           list([x[-5:] for x in candidate_fips]))
+            avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix - 1, _DASH_INDEX, median)
+            avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, _FIPS_P_INDEX, median)
+            avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix + 1, profile.fips_index, median,
+                                                           matched_suffixes)
             matched1 |= matched
             if matched:
-                if avgmsg[ix:ix + 6] in candidate_fips:
-                    candidate_fips.remove(avgmsg[ix:ix + 6])
+                fips = avgmsg[ix:ix + 6]
+                if matched_fips[fips] < profile.counties[fips]:
+                    matched_fips[fips] += 1
+                    matched_suffixes[fips[1:]] += 1
             else:
                 recheck.append(ix)
         return avgmsg, confidences, matched1, recheck
@@ -571,23 +763,23 @@ def average_message(headers, transmitter):
 
     # Reconcile purge time
     ix = len(avgmsg) - 23
-    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, ['+'])
+    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, _PLUS_INDEX, median)
     ix += 1
-    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, VALID_DURATIONS)
+    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, _DURATION_INDEX, median)
 
     # Reconcile issue time
     ix += 5
     valid_times = []
     for weight, offset in ((.5, -4), (.7, -3), (.9, -2), (1.1, -1), (1, 0)):
-        valid_times.append((weight, time.strftime('%j%H%M', time.gmtime(headers[0][2] + 60 * offset))))
-    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, valid_times)
+        valid_times.append((weight, time.strftime('%j%H%M', time.gmtime(when + 60 * offset))))
+    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, valid_times, median)
 
     # Reconcile the end
     ix += 8
-    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, wfo)
+    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, profile.wfo_index, median)
 
     ix += 5
-    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, ['NWS'])
+    avgmsg, confidences, matched = _reconcile_word(avgmsg, confidences, ix, _NWS_INDEX, median)
 
     return _unicodify(avgmsg), confidences[0:len(avgmsg)]
 
@@ -614,14 +806,111 @@ def __median(lst):
     return float(sum(sorted(lst)[quotient - 1:quotient + 1]) / 2)
 
 
-def _reconcile_word(msg, confidences, start, choices):
+class _CandidateIndex(object):
+    """
+    A trie of the choices for a word in a message, weighted by how likely each choice is.  Searching it finds the
+    nearest choices to a received word (by _word_distance / weight) without measuring the distance to every choice,
+    since whole branches can be skipped once they can't beat what has already been found.
+    """
+
+    class _Node(object):
+        __slots__ = ['children', 'leaves', 'max_weight']
+
+        def __init__(self):
+            self.children = {}
+            self.leaves = []  # (weight, choice) for choices that end at this node
+            self.max_weight = 0  # the greatest weight of any choice at or below this node
+
+    def __init__(self, choices):
+        """
+        :param choices: a list of choices, or tuples of weight and choice, as for _reconcile_word
+        """
+        try:
+            choices[0][0] + 0
+        except TypeError:
+            choices = list([(1, x) for x in choices])
+        except IndexError:
+            pass  # no choices
+        self.choices = choices
+        self.length = len(choices[0][1]) if len(choices) else 0
+        self.root = _CandidateIndex._Node()
+        for weight, c in choices:
+            node = self.root
+            node.max_weight = max(node.max_weight, weight)
+            for x in c:
+                node = node.children.setdefault(x, _CandidateIndex._Node())
+                node.max_weight = max(node.max_weight, weight)
+            node.leaves.append((weight, c))
+
+    def __len__(self):
+        return len(self.choices)
+
+    def nearest(self, word, confidence, excluded=None):
+        """
+        :param word: the received word
+        :param confidence: the confidence of each character of the word
+        :param excluded: a collections.Counter of choices to leave out, counting how many copies of each
+        :return: a sorted list of the (up to) two best tuples of ((_word_distance + 1) / weight, choice)
+        """
+        best = []
+
+        def consider(score, c):
+            candidate = (score, c)
+            if len(best) < 2:
+                best.append(candidate)
+                best.sort()
+            elif candidate < best[1]:
+                best[1] = candidate
+                best.sort()
+
+        def consider_leaves(node, d):
+            for weight, c in node.leaves:
+                if excluded and excluded[c]:
+                    # Skip as many copies as have been excluded
+                    skipped = skipping.get(c, 0)
+                    if skipped < excluded[c]:
+                        skipping[c] = skipped + 1
+                        continue
+                consider((d + 1) / weight, c)
+
+        def consider_subtree(node, d):
+            consider_leaves(node, d)
+            for child in node.children.values():
+                consider_subtree(child, d)
+
+        def search(node, depth, d):
+            consider_leaves(node, d)
+            if not node.children:
+                return
+            if depth >= len(word):
+                # _word_distance gives the same penalty to everything that runs past the end of the word
+                for child in node.children.values():
+                    consider_subtree(child, d + 9)
+                return
+            here = word[depth]
+            miss = d + 1 + confidence[depth]
+            match = node.children.get(here)
+            if match is not None:
+                search(match, depth + 1, d)
+            for x, child in node.children.items():
+                if x != here and (len(best) < 2 or (miss + 1) / child.max_weight <= best[1][0]):
+                    search(child, depth + 1, miss)
+
+        skipping = {}
+        search(self.root, 0, 0)
+        return best
+
+
+def _reconcile_word(msg, confidences, start, choices, median=None, excluded=None):
     """
 
     :param msg: the whole message
     :param confidences: confidences for each character in the message
     :param start: the index at which to look for the choices
     :param choices: a list of choices that might appear at the given index, or tuples of weight and choice
-    if there are different probabilities for different possibilities
+    if there are different probabilities for different possibilities, or a _CandidateIndex of them
+    :param median: the median of the confidences for the message, if it's already known
+    :param excluded: a collections.Counter of choices to leave out this time
     :return: a tuple of the corrected message, the corresponding confidence (as an array of ints range 0-9),
          and a boolean indicating if a suitable match was found
     """
@@ -636,19 +925,18 @@ def _reconcile_word(msg, confidences, start, choices):
         confidences[0] + 1
     except TypeError:
         confidences = list([int(x) for x in confidences])
-    try:
-        choices[0][0] + 0
-    except TypeError:
-        choices = list([(1, x) for x in choices])
+    if not isinstance(choices, _CandidateIndex):
+        choices = _CandidateIndex(choices)
+    if median is None:
+        median = __median(confidences)
 
-    end = start + len(choices[0][1])
+    end = start + choices.length
     word = msg[start:end]
     confidence = confidences[start:end]
-    candidates = []
-    for weight, c in choices:
-        candidates.append(((_word_distance(word, confidence, c) + 1) / weight, c))
-    candidates.sort()
-    if candidates[0][0] < max(4, __median(confidences)) and (
+    candidates = choices.nearest(word, confidence, excluded)
+    if not len(candidates):
+        return msg, confidences, False
+    if candidates[0][0] < max(4, median) and (
                     len(candidates) == 1 or candidates[0][0] < candidates[1][0]):
         word = candidates[0][1]
         # Update the confidence
@@ -664,9 +952,116 @@ def _reconcile_word(msg, confidences, start, choices):
     return msg, confidences, matched
 
 
+_ORIGINATOR_INDEX = _CandidateIndex(_ORIGINATOR_CODES)
+_EVENT_INDEX = _CandidateIndex(_EVENT_CODES)
+_DURATION_INDEX = _CandidateIndex(VALID_DURATIONS)
+_FIPS_P_INDEX = _CandidateIndex([(1.1, '0'), (1, '1'), (1, '2'), (1, '3'), (1, '4'),
+                                 (1, '5'), (1, '6'), (1, '7'), (1, '8'), (1, '9')])
+_DASH_INDEX = _CandidateIndex(['-'])
+_PLUS_INDEX = _CandidateIndex(['+'])
+_NWS_INDEX = _CandidateIndex(['NWS'])
+
+
+class DecodeProfile(object):
+    """
+    Everything about a transmitter that decoding its messages depends on, indexed once so that it needn't be
+    looked up again for each message.  Build it when tuning to the transmitter (see get_decode_profile).
+    """
+
+    def __init__(self, transmitter):
+        """
+        :param transmitter: Call letters for the transmitter, or None if it isn't known
+        """
+        self.transmitter = transmitter
+        try:
+            counties = list(get_counties(transmitter))
+        except KeyError:
+            counties = []
+        self.counties = collections.Counter(counties)  # A county listed twice can be matched twice
+        self.fips_index = _CandidateIndex([x[-5:] for x in counties])
+        try:
+            wfo = [get_wfo(transmitter)]
+        except KeyError:
+            wfo = []
+        self.wfo_index = _CandidateIndex(wfo)
+
+    def __str__(self):
+        return "%s(%s)" % (type(self).__name__, self.transmitter)
+
+
+_DECODE_PROFILES = {}
+
+
+def get_decode_profile(transmitter):
+    """
+    :param transmitter: Call letters for the transmitter, None, or a DecodeProfile (which is returned as is)
+    :return: the DecodeProfile for the transmitter, built the first time it is needed
+    """
+    if isinstance(transmitter, DecodeProfile):
+        return transmitter
+    try:
+        return _DECODE_PROFILES[transmitter]
+    except KeyError:
+        return _DECODE_PROFILES.setdefault(transmitter, DecodeProfile(transmitter))
+
+
 _END_SEQUENCE = "+0___-_______-____/NWS-"
 
 
+class FrameDetector(object):
+    """
+    Find the end of a SAME header as its bytes arrive, by scoring the _END_SEQUENCE at every length the header
+    could have (38 characters, plus 7 for each additional FIPS code).  Each byte adds to the score of the few
+    candidate ends it falls under, so the score for a length is final as soon as its last byte is fed, and
+    nothing needs to be scanned again once the header is complete.
+    """
+
+    def __init__(self):
+        self.length = 0  # how many bytes have been fed
+        self.candidates = []  # tuples of distance (as from _word_distance) and length, for each complete length
+        self.__pending = {}  # length: distance so far, for lengths still waiting on bytes
+        # As _truncate always has, a mismatch at position k of the _END_SEQUENCE is weighted by the confidence
+        # of byte k of the header
+        self.__weights = []
+
+    def feed(self, chars, confidences):
+        """
+        :param chars: the next characters (or bytes) of the header
+        :param confidences: the confidence of each
+        """
+        end_length = len(_END_SEQUENCE)
+        for c, confidence in zip(chars, confidences):
+            if not hasattr(c, 'lower'):
+                c = chr(c)
+            i = self.length
+            self.length += 1
+            if i < end_length:
+                self.__weights.append(confidence)
+            # The lengths for which this byte falls within the _END_SEQUENCE
+            l = max(38, i + 1)
+            l += (38 - l) % 7
+            while l <= i + end_length:
+                k = i - l + end_length
+                t = _END_SEQUENCE[k]
+                if t != '_' and c != t:
+                    self.__pending[l] = self.__pending.get(l, 0) + 1 + self.__weights[k]
+                l += 7
+            if self.length >= 38 and (self.length - 38) % 7 == 0:
+                self.candidates.append((self.__pending.pop(self.length, 0), self.length))
+
+    def best(self, max_length=None):
+        """
+        :param max_length: the longest the header can be, None for no limit
+        :return: a tuple of distance and length for the most likely length, or None if there isn't one yet
+        """
+        candidates = self.candidates
+        if max_length is not None:
+            candidates = [x for x in candidates if x[1] <= max_length]
+        if len(candidates) == 0:
+            return None
+        return min(candidates)
+
+
 def _truncate(avgmsg, confidences):
     """
     Compute the length of the message and fill in the punctuation characters.
@@ -679,12 +1074,11 @@ def _truncate(avgmsg, confidences):
         # It's too short; there's no hope
         return avgmsg, confidences
 
-    candidates = []
-    for l in range(38, len(avgmsg) + 1, 7):
-        candidates.append((_word_distance(avgmsg[l - 23:l], confidences, _END_SEQUENCE, '_'), l))
+    detector = FrameDetector()
+    detector.feed(avgmsg, confidences)
 
     # Decide which length candidate is the winner, truncate message and confidences accordingly
-    winner = min(candidates)
+    winner = detector.best()
     l = winner[1]
     avgmsg = avgmsg[0:l]
     confidences = confidences[0:l]
@@ -749,28 +1143,111 @@ def default_prioritization(event_type):
         return logging.INFO
 
 def default_SAME_sort(a, b):
-    apri = default_prioritization(a.get_event_type())
-    bpri = default_prioritization(b.get_event_type())
-    delta = bpri - apri # highest first
+    atype = a.get_event_type()
+    btype = b.get_event_type()
+    delta = default_prioritization(btype) - default_prioritization(atype)  # highest first
     if delta:
         return delta
 
-    delta = b.get_start_time_sec() - a.get_start_time_sec() # newest first
+    delta = b.get_start_time_sec() - a.get_start_time_sec()  # newest first
     if delta:
         return delta
 
-    if a.get_event_type() > b.get_event_type():
+    if atype > btype:
         return 1
-    elif a.get_event_type() < b.get_event_type():
+    elif atype < btype:
         return -1
 
-    if a.get_SAME_message() > b.get_SAME_message():
+    amsg = a.get_SAME_message()
+    bmsg = b.get_SAME_message()
+    if amsg > bmsg:
         return 1
-    elif a.get_SAME_message() < b.get_SAME_message():
+    elif amsg < bmsg:
         return -1
 
     return 0
 
+
+def default_SAME_sort_key(message):
+    """
+    :return: a key that puts messages in the same order as default_SAME_sort, for sorting without a comparator
+    """
+    event_type = message.get_event_type()
+    return -default_prioritization(event_type), -message.get_start_time_sec(), event_type, message.get_SAME_message()
+
+class _IntervalIndex(object):
+    """
+    Messages in order of their start times, so that the ones effective at some time (or at any time in a span)
+    can be found by bisection instead of by checking every message.  No message lasts longer than the longest
+    one added, so only those starting within that long before the span need to be checked.
+    """
+
+    def __init__(self):
+        self.__starts = []  # start times, in order
+        self.__entries = []  # tuples of start, end, and message, in the same order
+        self.__longest = 0
+
+    def add(self, message):
+        """
+        :param message: a message with a start time and an end time
+        """
+        start = message.get_start_time_sec()
+        end = message.get_end_time_sec()
+        if start is None:
+            start = float("-inf")
+        if end is None:
+            end = float("inf")
+        self.__longest = max(self.__longest, end - start)
+        ix = bisect.bisect_right(self.__starts, start)
+        self.__starts.insert(ix, start)
+        self.__entries.insert(ix, (start, end, message))
+
+    def overlapping(self, t0, t1=None):
+        """
+        :param t0: the beginning of the span of time
+        :param t1: the end of the span of time, default = t0
+        :return: a list of the messages effective at any time from t0 to t1 inclusive, in order of their start
+        """
+        if t1 is None:
+            t1 = t0
+        first = bisect.bisect_left(self.__starts, t0 - self.__longest)
+        last = bisect.bisect_right(self.__starts, t1)
+        return list([m for start, end, m in self.__entries[first:last] if end >= t0])
+
+    def remove(self, message):
+        """
+        :param message: the message to remove
+        :return: True if it was removed, False if it wasn't there
+        """
+        start = message.get_start_time_sec()
+        if start is None:
+            start = float("-inf")
+        for ix in range(bisect.bisect_left(self.__starts, start), bisect.bisect_right(self.__starts, start)):
+            if self.__entries[ix][2] is message:
+                del self.__starts[ix]
+                del self.__entries[ix]
+                return True
+        return False
+
+    def retain(self, t0, t1=None):
+        """
+        Drop the messages that are not effective at any time from t0 to t1 inclusive.
+        """
+        if t1 is None:
+            t1 = t0
+        first = bisect.bisect_left(self.__starts, t0 - self.__longest)
+        last = bisect.bisect_right(self.__starts, t1)
+        self.__entries = list([x for x in self.__entries[first:last] if x[1] >= t0])
+        self.__starts = list([x[0] for x in self.__entries])
+        self.__longest = max([0] + [end - start for start, end, m in self.__entries])
+
+    def __iter__(self):
+        return iter([m for start, end, m in self.__entries])
+
+    def __len__(self):
+        return len(self.__entries)
+
+
 class SAMECache(object):
     """
     SAMECache holds a collection of (presumably recent) SAME messages.
@@ -778,56 +1255,249 @@ class SAMECache(object):
     Responsibilities:
     0. Know its county
     1. Receive SAME messages
+    2. Index the messages by the counties they cover
     3. Provide a list of effective messages for a specific county in priority order
     4. Clear out inactive messages upon request
 
     Collaborators:
     Si4707 to populate via SAME message events
     A consumer, to monitor the messages and clear out inactive messages
+    An ExpirySweeper (optional), to evict messages as they expire
     """
     # TODO track the time since last received message for my fips, alert if >8 days
     # TODO monitor RSSI & SNR and alert if out of spec (what is spec)?
-    def __init__(self, county_fips, same_sort=default_SAME_sort):
+    def __init__(self, county_fips, same_sort=default_SAME_sort, sweeper=None):
+        """
+        :param county_fips: the county of interest, None to treat every county as local
+        :param same_sort: a comparator for putting messages in priority order
+        :param sweeper: an ExpirySweeper to evict messages as they expire, None to leave them until clear_inactive
+        """
         self.__messages_lock = threading.Lock()
-        self.__messages = []
-        self.__elsewhere_messages = []
-        self.__local_messages = []
+        self.__messages = _IntervalIndex()
+        self.__elsewhere_messages = _IntervalIndex()
+        # Tuples of sort key, serial number, and message for each of the local and elsewhere messages, kept in order
+        self.__by_priority = {True: [], False: []}
+        self.__serial = 0
+        # county (the last 5 digits of its FIPS code): {P-code: _IntervalIndex of the messages naming it}
+        self.__by_fips = {}
         self.county_fips = county_fips
         self.same_sort = same_sort
+        self.sweeper = sweeper
+        if same_sort is default_SAME_sort:
+            self.__sort_key = default_SAME_sort_key
+        else:
+            self.__sort_key = functools.cmp_to_key(same_sort)
+        self.metrics = Metrics({"query_results": SIZE_BUCKETS})
+
+    def stats(self):
+        """
+        :return: a dict of the counts of messages added, messages evicted and queries, and histograms (as from
+           RPiNWR.metrics.Histogram.to_dict) of the seconds spent waiting for the lock, and of the seconds taken by,
+           seconds spent sorting in, and number of messages returned by get_messages_active_between (and so
+           get_active_messages).  RPiNWR.metrics.to_prometheus will format it for Prometheus.
+        """
+        return self.metrics.stats()
+
+    def __acquire(self):
+        """
+        Take the lock, noting how long it took
+        """
+        start = time.perf_counter()
+        self.__messages_lock.acquire()
+        self.metrics.observe("lock_wait_seconds", time.perf_counter() - start)
 
     def add_message(self, message):
-        with self.__messages_lock:
-            if self.county_fips is None or message.applies_to_fips(self.county_fips):
-                self.__messages.append(message)
+        self.__acquire()
+        try:
+            here = self.county_fips is None or message.applies_to_fips(self.county_fips)
+            if here:
+                self.__messages.add(message)
             else:
-                self.__elsewhere_messages.append(message)
+                self.__elsewhere_messages.add(message)
+            self.__serial += 1
+            bisect.insort(self.__by_priority[here], (self.__sort_key(message), self.__serial, message))
+            for county in set(message.get_counties()):
+                if len(county) == 6:
+                    self.__by_fips.setdefault(county[1:], {}).setdefault(county[0], _IntervalIndex()).add(message)
+        finally:
+            self.__messages_lock.release()
+        self.metrics.count("added")
+        if self.sweeper is not None:
+            self.sweeper.schedule(message.get_end_time_sec(), functools.partial(self.__expire, message, here))
+
+    def __expire(self, message, here, when):
+        """
+        Called by the sweeper when the message expires.
 
-    def get_active_messages(self, when=None, event_pattern=None, here=True):
+        :return: a list of the message, or an empty list if it was already cleared out
+        """
+        self.__acquire()
+        try:
+            if here:
+                removed = self.__messages.remove(message)
+            else:
+                removed = self.__elsewhere_messages.remove(message)
+            l = self.__by_priority[here]
+            ix = bisect.bisect_left(l, (self.__sort_key(message),))
+            while ix < len(l) and l[ix][2] is not message:
+                ix += 1
+            if ix < len(l):
+                del l[ix]
+            for county in set(message.get_counties()):
+                index = self.__by_fips.get(county[1:], {}).get(county[0:1])
+                if len(county) == 6 and index is not None:
+                    index.remove(message)
+                    if not len(index):
+                        del self.__by_fips[county[1:]][county[0]]
+                        if not len(self.__by_fips[county[1:]]):
+                            del self.__by_fips[county[1:]]
+        finally:
+            self.__messages_lock.release()
+        if removed:
+            self.metrics.count("evicted")
+            return [message]
+        return []
+
+    def get_active_messages(self, when=None, event_pattern=None, here=True, fips=None):
         """
         :param when: the time for which to check effectiveness of the messages, default = the present time
         :param event_pattern: a regular expression to match the desired event codes.  default = all.
         :param here: True to retrieve local messages, False to retrieve those for other locales
+        :param fips: a county (as for SAMEMessage.applies_to_fips) to retrieve the messages for, instead of here or
+           elsewhere
         """
         if when is None:
             when = time.time()
+        return self.get_messages_active_between(when, when, event_pattern, here, fips)
+
+    def get_messages_active_between(self, start, end, event_pattern=None, here=True, fips=None):
+        """
+        :param start: the beginning of the span of time, inclusive
+        :param end: the end of the span of time, inclusive
+        :param event_pattern: a regular expression to match the desired event codes.  default = all.
+        :param here: True to retrieve local messages, False to retrieve those for other locales
+        :param fips: a county (as for SAMEMessage.applies_to_fips) to retrieve the messages for, instead of here or
+           elsewhere
+        :return: the messages effective at any time in the span, in priority order
+        """
+        query_start = time.perf_counter()
         if event_pattern is None:
             event_pattern = re.compile(".*")
         elif not hasattr(event_pattern, 'match'):
             event_pattern = re.compile(event_pattern)
 
-        if here:
-            msgs = self.__messages
+        if fips is not None:
+            msgs = self.__for_fips(fips, start, end)
+        elif here:
+            msgs = self.__messages.overlapping(start, end)
         else:
-            msgs = self.__elsewhere_messages
-
-        l = list(filter(lambda m: m.is_effective(when) and event_pattern.match(m.get_event_type()), msgs))
-        l.sort(key=functools.cmp_to_key(self.same_sort))
+            msgs = self.__elsewhere_messages.overlapping(start, end)
+
+        l = list(filter(lambda m: event_pattern.match(m.get_event_type()), msgs))
+        sort_start = time.perf_counter()
+        l.sort(key=self.__sort_key)
+        finish = time.perf_counter()
+        self.metrics.count("queries")
+        self.metrics.observe("query_seconds", finish - query_start)
+        self.metrics.observe("sort_seconds", finish - sort_start)
+        self.metrics.observe("query_results", len(l))
         return l
 
+    def __for_fips(self, fips, start, end):
+        """
+        :return: the messages that apply to the county (as by SAMEMessage.applies_to_fips) and are effective at any
+           time in the span, in no particular order
+        """
+        if len(fips) == 5:
+            fips = '0' + fips
+        if len(fips) != 6:
+            raise ValueError()
+
+        # The whole county (P-code 0) includes every part, and every part is in a message for the whole county
+        subdivisions = self.__by_fips.get(fips[1:], {})
+        if fips[0] == '0':
+            indexes = list(subdivisions.values())
+        else:
+            indexes = list([subdivisions[p] for p in set([fips[0], '0']) if p in subdivisions])
+
+        if len(indexes) == 1:
+            return indexes[0].overlapping(start, end)
+        found = {}
+        for index in indexes:
+            for m in index.overlapping(start, end):
+                found[id(m)] = m
+        return list(found.values())
+
+    def get_top_message(self, when=None, here=True):
+        """
+        :param when: the time for which to check effectiveness of the messages, default = the present time
+        :param here: True for the top local message, False for the top message for other locales
+        :return: the highest priority effective message, or None if there is none.  This is the first message
+           from get_active_messages, found without sorting anything.
+        """
+        if when is None:
+            when = time.time()
+        for key, serial, m in self.__by_priority[here]:
+            if m.is_effective(when):
+                return m
+        return None
+
     def clear_inactive(self, when=None):
-        with self.__messages_lock:
-            self.__messages = self.get_active_messages(when)
-            self.__elsewhere_messages = self.get_active_messages(when, here=False)
+        if when is None:
+            when = time.time()
+        self.__acquire()
+        try:
+            before = len(self.__messages) + len(self.__elsewhere_messages)
+            self.__messages.retain(when)
+            self.__elsewhere_messages.retain(when)
+            evicted = before - len(self.__messages) - len(self.__elsewhere_messages)
+            for here, l in self.__by_priority.items():
+                self.__by_priority[here] = list([x for x in l if x[2].is_effective(when)])
+            for county, subdivisions in list(self.__by_fips.items()):
+                for p, index in list(subdivisions.items()):
+                    index.retain(when)
+                    if not len(index):
+                        del subdivisions[p]
+                if not len(subdivisions):
+                    del self.__by_fips[county]
+        finally:
+            self.__messages_lock.release()
+        self.metrics.count("evicted", evicted)
+
+    def snapshot(self, when=None):
+        """
+        :param when: the time of the snapshot, default = the present time
+        :return: the messages in the order received, as simple types (for JSON, as by
+           RPiNWR.snapshot.write_snapshot), for restore
+        """
+        if when is None:
+            when = time.time()
+        self.__acquire()
+        try:
+            received = sorted(self.__by_priority[True] + self.__by_priority[False], key=lambda x: x[1])
+        finally:
+            self.__messages_lock.release()
+        return {"kind": "SAMECache", "time": when, "messages": list([m.to_dict() for key, serial, m in received])}
+
+    def restore(self, snapshot, when=None):
+        """
+        Add the messages from a snapshot, leaving out those that have expired.  They are not decoded again.
+
+        :param snapshot: as from snapshot
+        :param when: the time from which to judge the messages expired, default = the present time
+        :return: the number of messages restored
+        """
+        if snapshot.get("kind") != "SAMECache":
+            raise ValueError("Not a SAMECache snapshot: %s" % snapshot.get("kind"))
+        if when is None:
+            when = time.time()
+        restored = 0
+        for d in snapshot["messages"]:
+            message = SAMEMessage.from_dict(d)
+            if message.get_end_time_sec() >= when:
+                self.add_message(message)
+                restored += 1
+        return restored
 
 
 def _unicodify(str):
@@ -27,11 +27,15 @@ __author__ = 'ke4roh'
 import queue
 import heapq
 import threading
+import concurrent.futures
 from RPiNWR.Si4707.commands import *
 from RPiNWR.Si4707.data import *
 from RPiNWR.Si4707.events import *
 from RPiNWR.Si4707.exceptions import *
+from RPiNWR.Si4707.cts import CTSInterrupt, CTSPolling
+from RPiNWR.metrics import Metrics
 from RPiNWR.nwr_data import *
+from RPiNWR.SAME import get_decode_profile
 
 
 class Si4707(object):
@@ -41,6 +45,7 @@ class Si4707(object):
         self.__command_serial_number = 0
         self.__command_serial_number_lock = threading.Lock()
         self.__event_listeners = []
+        self.__event_listeners_lock = threading.Lock()
         self.__delayed_events = []
         self.__delayed_event_lock = threading.Lock()
         self.tune_after = float("inf")
@@ -54,6 +59,13 @@ class Si4707(object):
         self.same_message = None
         self.last_EOM = 0
         self.transmitter = None
+        self.decode_profile = get_decode_profile(None)  # for decoding SAME messages from this transmitter
+        self.interrupt_check_sec = 1.0  # how often to check interrupts anyway, with a context that signals them
+        self.cts_key = "RESET"  # the mnemonic of the command waiting for CTS, for cts_metrics
+        self.cts_interrupt = False  # True if the radio was powered up to interrupt on CTS
+        self.cts_polling = CTSPolling()
+        self.cts_interrupts = CTSInterrupt()
+        self.cts_metrics = Metrics()  # cts_seconds_<mnemonic> histograms, and how many times the status was read
 
     def __enter__(self):
         try:
@@ -87,30 +99,64 @@ class Si4707(object):
             # checking message.fully_received() will dispatch it if it's finished
             pass
 
+    def __idle_timeout(self, next_check):
+        """
+        :param next_check: the time.time() at which to check the interrupts regardless
+        :return: how long the command loop may wait for an interrupt or a command
+        """
+        until = next_check
+        message = self.same_message
+        if message is not None and message.received_callback is not None:
+            until = min(until, message.timeout)  # so that it will be dispatched when it times out
+        return max(0, until - time.time())
+
     def __command_loop(self):
+        # With an interrupt line, the interrupts are checked only when it signals, when handling the last ones
+        # might have left more, and every interrupt_check_sec in case an edge was missed.  Otherwise, every pass.
+        interrupt_line = getattr(self.context, "has_interrupt_line", False)
+        pending = True
+        next_check = 0
         while not self.stop:
             command = None
             try:
-                # Check for interrupts
-                status = self.check_interrupts()
-                if status.is_same_interrupt():
-                    self.do_command(SameInterruptCheck(intack=True))
-                if status.is_audio_signal_quality_interrupt():
-                    self.do_command(AlertToneCheck(True))
-                if status.is_received_signal_quality_interrupt():
-                    self.do_command(ReceivedSignalQualityCheck(True))
+                if pending or not interrupt_line or time.time() >= next_check:
+                    # Check for interrupts
+                    status = self.check_interrupts()
+                    if status.is_same_interrupt():
+                        self.do_command(SameInterruptCheck(intack=True))
+                    if status.is_audio_signal_quality_interrupt():
+                        self.do_command(AlertToneCheck(True))
+                    if status.is_received_signal_quality_interrupt():
+                        self.do_command(ReceivedSignalQualityCheck(True))
+                    pending = status.is_interrupt()
+                    next_check = time.time() + self.interrupt_check_sec
 
                 # Check for a SAME message to dispatch
                 self._dispatch_any_message()
 
                 # Run any pending command
-                command = self.__command_queue.get(block=True, timeout=0.05)[1]
+                if interrupt_line and not pending:
+                    try:
+                        command = self.__command_queue.get_nowait()[1]
+                    except queue.Empty:
+                        # Sleep until the radio interrupts or a command is queued
+                        pending = self.context.wait_for_interrupt(self.__idle_timeout(next_check))
+                        raise
+                else:
+                    command = self.__command_queue.get(block=True, timeout=0.05)[1]
+                if command.future is not None and not command.future.set_running_or_notify_cancel():
+                    self._logger.debug("Cancelled " + str(command))
+                    continue
                 command.do_command(self)
                 self._logger.debug("Executed " + str(command))
+                if isinstance(command, CommandBatch):
+                    for c in command.commands:
+                        if c.time_complete is not None and not c.exception:
+                            self._fire_event(c)
                 if command.exception:
                     # Logged where it's caught in command
                     self._fire_event(CommandExceptionEvent(command.exception, passed_back=True))
-                else:
+                elif not isinstance(command, CommandBatch):
                     self._fire_event(command)
             except queue.Empty:
                 try:
@@ -136,8 +182,8 @@ class Si4707(object):
         while not self.__command_queue.empty():
             try:
                 cmd = self.__command_queue.get(block=False)[1]
-                if cmd.future:
-                    cmd.future.exception(stopped_exception)
+                if cmd.future and cmd.future.set_running_or_notify_cancel():
+                    cmd.future.set_exception(stopped_exception)
             except queue.Empty:
                 pass  # Success!
         self.__command_queue = None
@@ -185,29 +231,47 @@ class Si4707(object):
         self._logger.debug("Scheduled " + str(event) + " for " + str(when) + " which is " + str(
             int((when - time.time()) * 1000)) + " ms in the future.")
 
-    def wait_for_clear_to_send(self, timeout=1.0):
+    def wait_for_clear_to_send(self, timeout=1.0, key=None, command_sent=True):
         """
+        Wait for the interrupt that comes with CTS if the radio was powered up to send one and the context has an
+        interrupt line, otherwise poll the status, backing off from how long the command usually takes.
+
         :param: timeout - in seconds, how long to wait.  Default=1
+        :param key: the name of what is being waited for in cts_metrics, default cts_key
+        :param command_sent: False if no command was sent since the last wait, so that no interrupt will come with CTS
         :return: the current status which can be inspected for CTS
         :raises: StatusError if the status indicates CTS and an error
                  NotClearToSend if the time expires without getting a CTS
         """
-        if timeout is not None:
-            expiry = timeout + time.time()
-        while expiry is None or time.time() < expiry:
-            try:
-                self.status = Status(self.context.read_bytes(1))
-                if self.status.is_clear_to_send():
-                    return self.status
-                else:
-                    time.sleep(.002)
-            except OSError as e:
-                if e.errno == 5:  # I/O error - GPIO is busted
-                    self.stop = 1
-                    self._logger.fatal("I/O error")
-                    self._logger.exception("I/O error")
-                raise
-        raise NotClearToSend()
+        if key is None:
+            key = self.cts_key
+        start = time.time()
+        expiry = None if timeout is None else start + timeout
+        if command_sent and self.cts_interrupt and getattr(self.context, "has_interrupt_line", False):
+            strategy = self.cts_interrupts
+        else:
+            strategy = self.cts_polling
+        try:
+            status = strategy.wait(self, key, expiry)
+        except OSError as e:
+            if e.errno == 5:  # I/O error - GPIO is busted
+                self.stop = 1
+                self._logger.fatal("I/O error")
+                self._logger.exception("I/O error")
+            raise
+        if status is None:
+            raise NotClearToSend()
+        self.cts_metrics.observe("cts_seconds_" + key, time.time() - start)
+        return status
+
+    def _read_status(self):
+        """
+        Read the status from the chip (for waiting on CTS)
+        :return: the status, also in self.status
+        """
+        self.cts_metrics.count("cts_status_reads")
+        self.status = Status(self.context.read_bytes(1))
+        return self.status
 
     def check_interrupts(self):
         """
@@ -217,15 +281,26 @@ class Si4707(object):
         the actual interrupts at hand, but subsequent examination of self.status is preferable for identifying
         which interrupts.
         """
-        self.wait_for_clear_to_send(timeout=5)
+        self.wait_for_clear_to_send(timeout=5, key="ready", command_sent=False)
+        if getattr(self.context, "has_interrupt_line", False):
+            self.context.wait_for_interrupt(0)  # Whatever it signaled until now, GET_INT_STATUS will report
         self.context.write_bytes([0x14])  # GET_INT_STATUS Tell Si4707 to populate interrupt bits
-        return self.wait_for_clear_to_send(timeout=.1)
+        return self.wait_for_clear_to_send(timeout=.1, key="GET_INT_STATUS")
 
     def register_event_listener(self, callback):
         """
         :param callback: A function taking one parameter, an SI4707Event.  This method will be called for every event.
         """
-        self.__event_listeners.append(callback)
+        # Replace the list rather than changing it, so as not to disturb an iteration of it in the event loop
+        with self.__event_listeners_lock:
+            self.__event_listeners = self.__event_listeners + [callback]
+
+    def unregister_event_listener(self, callback):
+        """
+        :param callback: a function passed to register_event_listener, to be called no more
+        """
+        with self.__event_listeners_lock:
+            self.__event_listeners = [x for x in self.__event_listeners if x is not callback]
 
     def _fire_event(self, event):
         """
@@ -243,12 +318,11 @@ class Si4707(object):
             config.update(configuration)
 
         if config["power_on"].get("patch"):
-            self.do_command(PatchCommand(**config["power_on"]))
+            commands = [PatchCommand(**config["power_on"])]
         else:
-            self.do_command(PowerUp())
-
-        for (prop, value) in config["properties"].items():
-            self.set_property(prop, value)
+            commands = [PowerUp()]
+        commands.extend([SetProperty(prop, value) for (prop, value) in config["properties"].items()])
+        self.do_commands(commands).get()
 
         if config.get("transmitter", None):
             self.tune(config.get("transmitter"))
@@ -274,11 +348,13 @@ class Si4707(object):
                     off = PowerDown()
                     off.future = Future()
                     self.__command_queue.put_nowait((0, off))
+                    self.__wake()
                     # wait for it to finish
                     off.future.get()
                 else:
                     self.power_off()
             self.stop = True
+            self.__wake()
 
             while self.__event_queue is not None or self.__command_queue is not None:
                 time.sleep(.002)
@@ -308,8 +384,28 @@ class Si4707(object):
 
         command.future = Future()
         self.__command_queue.put_nowait((serial << command.get_priority(), command))
+        self.__wake()
         return command.future
 
+    def do_commands(self, commands):
+        """
+        Put several commands on the queue to be executed together, one after the other, with nothing in between.
+        If one fails, the rest are not executed.
+
+        :param commands: the commands
+        :return: a Future for the list of their results
+        """
+        return self.do_command(CommandBatch(commands))
+
+    def __wake(self):
+        """
+        Wake the command loop if it's waiting for an interrupt
+        """
+        try:
+            self.context.wake()
+        except AttributeError:
+            pass  # It's a context that can't wait for interrupts, so the command loop isn't waiting
+
     def queue_callback(self, func, args=None, kw_args=None):
         """
         Call the named function from the command queue. Block until it's done,
@@ -346,13 +442,22 @@ class Si4707(object):
            to validate SAME messages received, so it is helpful to have them.
         :return: a tuple of RSSI (dBµV), SNR (dB), and frequency
         """
+        return self.do_command(self._tune_command(transmitter)).get()
+
+    def _tune_command(self, transmitter):
+        """
+        Get ready to receive from the transmitter
+        :param transmitter: as for tune
+        :return: the command to tune to it
+        """
         try:
             frequency = get_frequency(transmitter)
             self.transmitter = transmitter
         except KeyError:
             frequency = transmitter + 0  # Maybe it's a number?
             self.transmitter = None
-        return self.do_command(TuneFrequency(frequency)).get()
+        self.decode_profile = get_decode_profile(self.transmitter)
+        return TuneFrequency(frequency)
 
     def tune_status(self):
         """
@@ -416,50 +521,25 @@ class Si4707(object):
         self.do_command(SetAGCStatus(enabled)).get()
 
 
-class Future(object):
+class Future(concurrent.futures.Future):
     """
-    A container for a result that is expected after some time.
+    A container for a result that is expected after some time, which can be waited on with others
+    (concurrent.futures.wait), or handed to asyncio (see RPiNWR.Si4707.aio).
     """
 
-    def __init__(self):
-        self.__condition = threading.Condition()
-        self.__value = None
-        self.__exception = None
-        self.__complete = False
-
     def get(self, timeout=None):
         """
         :return: the result of the operation once it is ready, blocking until then
+        :raises: FutureException from the command's exception, if it failed
+                 TimeoutError if it isn't done in time
         """
-        if not self.__complete:
-            with self.__condition:
-                while not self.__complete:
-                    self.__condition.wait(timeout=timeout)
-                    if not self.__complete:
-                        raise TimeoutError()
-
-        if self.__exception:
-            raise FutureException from self.__exception
-
-        return self.__value
-
-    def result(self, value):
-        """
-        This result will be returned to the consumer
-        """
-        with self.__condition:
-            self.__value = value
-            self.__complete = True
-            self.__condition.notify_all()
-
-    def exception(self, exception):
-        """
-        This exception will be raised from get for the consumer
-        """
-        with self.__condition:
-            self.__exception = exception
-            self.__complete = True
-            self.__condition.notify()
+        try:
+            exception = self.exception(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError()  # not the same class before Python 3.11
+        if exception is not None:
+            raise FutureException from exception
+        return self.result()
 
 
 class Context(object):
@@ -468,10 +548,46 @@ class Context(object):
     It is also responsible for cleaning itself up as necessary.
     """
 
+    # True if the context calls interrupt when the radio raises its interrupt line, so the radio needn't be polled
+    has_interrupt_line = False
+
     def __init__(self):
         if type(self) is Context:
             raise NotImplemented()
         self._logger = logging.getLogger(type(self).__name__)
+        self.__wakeup = threading.Condition()
+        self.__interrupted = False
+        self.__woken = False
+
+    def interrupt(self):
+        """
+        Note that the radio raised its interrupt line.  Contexts that can see the line call this.
+        """
+        with self.__wakeup:
+            self.__interrupted = True
+            self.__wakeup.notify_all()
+
+    def wake(self):
+        """
+        End a wait_for_interrupt early, without an interrupt (because there is a command to send, for example).
+        """
+        with self.__wakeup:
+            self.__woken = True
+            self.__wakeup.notify_all()
+
+    def wait_for_interrupt(self, timeout=None):
+        """
+        Block until the radio raises its interrupt line, wake is called, or the time runs out.
+
+        :param timeout: the longest to wait, in seconds, None to wait indefinitely
+        :return: True if the radio raised its interrupt line since the last wait, False otherwise
+        """
+        with self.__wakeup:
+            if not (self.__interrupted or self.__woken):
+                self.__wakeup.wait(timeout)
+            interrupted = self.__interrupted
+            self.__interrupted = self.__woken = False
+        return interrupted
 
     def reset_radio(self):
         """
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# An asyncio front end for the Si4707
+#
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+from RPiNWR.Si4707.commands import *
+
+
+class AsyncSi4707(object):
+    """
+    Operate an Si4707 from an asyncio event loop.
+
+    Commands still go through the radio's command queue and run on its command thread; completing one hands the
+    result to the event loop, so nothing waits in a thread of its own.  Likewise, events come from the radio's event
+    thread.  The Si4707 must already be started (as with its "with" statement).
+    """
+
+    def __init__(self, radio):
+        """
+        :param radio: the Si4707 to operate
+        """
+        self.radio = radio
+        self._logger = logging.getLogger(type(self).__name__)
+
+    def do_command(self, command):
+        """
+        Put a command on the radio's queue
+        :return: an asyncio future for the command's result, raising as Future.get would
+        """
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+
+        def transfer(future):
+            if not result.cancelled():
+                try:
+                    result.set_result(future.get())
+                except Exception as e:
+                    result.set_exception(e)
+
+        def done(future):
+            try:
+                loop.call_soon_threadsafe(transfer, future)
+            except RuntimeError:
+                pass  # The event loop is closed, so nobody's waiting
+
+        self.radio.do_command(command).add_done_callback(done)
+        return result
+
+    def do_commands(self, commands):
+        """
+        Put several commands on the radio's queue to be executed together, as for Si4707.do_commands
+        :return: an asyncio future for the list of their results
+        """
+        return self.do_command(CommandBatch(commands))
+
+    async def queue_callback(self, func, args=None, kw_args=None):
+        """
+        Call the function from the command queue
+        :return: Whatever the function returned
+        """
+        return await self.do_command(Callback(func, args, kw_args))
+
+    async def get_property(self, property_mnemonic):
+        """
+        As for Si4707.get_property
+        """
+        return await self.do_command(GetProperty(property_mnemonic))
+
+    async def set_property(self, property_mnemonic, value):
+        """
+        As for Si4707.set_property
+        """
+        return await self.do_command(SetProperty(property_mnemonic, value))
+
+    async def tune(self, transmitter):
+        """
+        As for Si4707.tune
+        """
+        return await self.do_command(self.radio._tune_command(transmitter))
+
+    async def tune_status(self):
+        """
+        As for Si4707.tune_status
+        """
+        return await self.do_command(TuneStatus())
+
+    async def set_volume(self, loud):
+        """
+        :param loud: 0<=loud<=63
+        """
+        await self.set_property("RX_VOLUME", int(min(63, max(0, loud))))
+
+    async def get_volume(self):
+        """
+        :return:  0<=loud<=63
+        """
+        return await self.get_property("RX_VOLUME")
+
+    async def get_mute(self):
+        return await self.get_property("RX_HARD_MUTE") > 0
+
+    async def mute(self, hush):
+        """
+        :param hush: True to mute the speaker, False otherwise
+        """
+        await self.set_property("RX_HARD_MUTE", (hush & 1) * 3)
+
+    async def power_off(self):
+        return await self.do_command(PowerDown())
+
+    async def events(self, maxsize=100):
+        """
+        Iterate over the radio's events (as from register_event_listener) from the time this is first awaited,
+        until the iteration stops.
+
+        :param maxsize: how many events to hold for a slow consumer before dropping the oldest
+        """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize)
+
+        def put(event):
+            if events.full():
+                self._logger.warning("Dropped %s" % events.get_nowait())
+            events.put_nowait(event)
+
+        def listener(event):
+            try:
+                loop.call_soon_threadsafe(put, event)
+            except RuntimeError:
+                self.radio.unregister_event_listener(listener)  # The event loop is closed
+
+        self.radio.register_event_listener(listener)
+        try:
+            while True:
+                yield await events.get()
+        finally:
+            self.radio.unregister_event_listener(listener)
@@ -53,21 +53,24 @@ class Command(Symbol):
         self._logger = logging.getLogger(type(self).__name__)
 
     def do_command(self, radio):
+        cts_key = radio.cts_key
+        radio.cts_key = self.mnemonic
         try:
             result = self.do_command0(radio)
             if result == self:
                 result = "self"
             self.result = result
             if self.future:
-                self.future.result(self.result)
+                self.future.set_result(self.result)
         except Exception as e:
             self._logger.exception("failed")
             self.exception = e
             if self.future:
-                self.future.exception(e)
+                self.future.set_exception(e)
             else:
                 raise
         finally:
+            radio.cts_key = cts_key
             self.future = None
             self.time_complete = time.time()
 
@@ -145,6 +148,7 @@ class PowerUp(Command):
                                    _bit(self.crystal_oscillator_enable, 4) |
                                    self.function,
                                    self.opmode])
+        radio.cts_interrupt = self.cts_interrupt_enable
         return radio.wait_for_clear_to_send()
 
     def get_priority(self):
@@ -175,7 +179,7 @@ class PatchCommand(PowerUp):
 
         for i in range(0, len(patch), 8):
             radio.context.write_bytes(list(patch[i:i + 8]))
-            radio.wait_for_clear_to_send()
+            radio.wait_for_clear_to_send(key="PATCH")
 
         new_rev = GetRevision().do_command0(radio)
         # Revision [mchip_rev: 0, patch_id: 53653, component_revision: 2.0, part_number: 7, firmware: 2.0]
@@ -225,6 +229,7 @@ class PowerDown(CommandRequiringPowerUp):
     def do_command0(self, radio):
         super(PowerDown, self).do_command0(radio)
         radio.radio_power = False
+        radio.cts_interrupt = False
         radio._fire_event(RadioPowerEvent(False))
 
     def get_priority(self):
@@ -242,6 +247,9 @@ class SetProperty(CommandRequiringPowerUp):
         c = [self.value]
         c.extend(list(struct.pack(">bHH", 0, self.property.code, self.property.value)))
         radio.context.write_bytes(c)
+        radio.wait_for_clear_to_send()  # so that the next command, maybe in the same batch, can follow
+        if self.property.mnemonic == "GPO_IEN":
+            radio.cts_interrupt = bool(self.property.value & 0x80)  # CTSIEN
 
 
 class GetProperty(CommandRequiringPowerUp):
@@ -362,6 +370,10 @@ class AlertToneCheck(InterruptHandler):
                 radio.tone_start = None
 
 
+# The confidence of each of 4 bytes of a SAME header, from a byte of the WB_SAME_STATUS response, LSB first
+_SAME_CONFIDENCE = [bytes([b & 3, b >> 2 & 3, b >> 4 & 3, b >> 6 & 3]) for b in range(256)]
+
+
 class SameInterruptCheck(InterruptHandler):
     def __init__(self, intack=False, clearbuf=False):
         super(SameInterruptCheck, self).__init__(mnemonic="WB_SAME_STATUS", value=0x54)
@@ -387,22 +399,14 @@ class SameInterruptCheck(InterruptHandler):
                     radio._fire_event(EndOfMessage())
             if status["PREDET"]:
                 if not radio.same_message or radio.same_message.fully_received(extend_timeout=True):
-                    radio.same_message = SAME.SAMEMessage(radio.transmitter, received_callback=dispatch_message)
+                    radio.same_message = SAME.SAMEMessage(radio.decode_profile, received_callback=dispatch_message)
             if status["HDRRDY"]:
                 if not radio.same_message or radio.same_message.fully_received():
-                    radio.same_message = SAME.SAMEMessage(radio.transmitter, received_callback=dispatch_message)
-                msg = list(self.status["MESSAGE"])
-                conf = list(self.status["CONFIDENCE"])
-                msg_len = self.status["MSGLEN"]
-                while len(msg) < msg_len:
-                    st = self.__get_status(radio, readaddr=len(msg))
-                    msg.extend(st["MESSAGE"])
-                    conf.extend(st["CONFIDENCE"])
-                msg = msg[0:msg_len + 1]
-                conf = conf[0:msg_len + 1]
-                radio.same_message.add_header("".join([chr(c) for c in msg]), conf)
+                    radio.same_message = SAME.SAMEMessage(radio.decode_profile, received_callback=dispatch_message)
+                msg, conf, frame = self.__read_header(radio, status)
+                radio.same_message.add_header(msg, conf)
                 self.__get_status(radio, clearbuf=True)
-                radio._fire_event(SAMEHeaderReceived(radio.same_message))
+                radio._fire_event(SAMEHeaderReceived(radio.same_message, frame.best(len(msg))))
 
     def __str__(self):
         msg = type(self).__name__ + " ["
@@ -428,13 +432,39 @@ class SameInterruptCheck(InterruptHandler):
         msg += "]"
         return msg
 
+    def __read_header(self, radio, status):
+        """
+        Read the rest of the header from the SAME buffer, 8 bytes at a time, straight into buffers for it, finding
+        the end of the header as it's read.
+
+        :param status: from __get_status, with the first 8 bytes
+        :return: bytearrays of the header and the confidence of each byte, and the SAME.FrameDetector fed with them
+        """
+        msg_len = status["MSGLEN"]
+        size = max(8, (msg_len + 7) // 8 * 8)
+        msg = bytearray(size)
+        conf = bytearray(size)
+        msg[0:8] = bytes(status["MESSAGE"])
+        conf[0:8] = bytes(status["CONFIDENCE"])
+        frame = SAME.FrameDetector()
+        frame.feed(msg[0:8], conf[0:8])
+        context = radio.context
+        for readaddr in range(8, msg_len, 8):
+            context.write_bytes([self.value, 0, readaddr])
+            radio.wait_for_clear_to_send()
+            data = context.read_bytes(14)
+            msg[readaddr:readaddr + 8] = bytes(data[6:14])
+            conf[readaddr:readaddr + 8] = _SAME_CONFIDENCE[data[5]] + _SAME_CONFIDENCE[data[4]]
+            frame.feed(msg[readaddr:readaddr + 8], conf[readaddr:readaddr + 8])
+        del msg[msg_len + 1:]
+        del conf[msg_len + 1:]
+        return msg, conf, frame
+
     def __get_status(self, radio, readaddr=0, clearbuf=False, intack=False):
         radio.context.write_bytes([self.value, (clearbuf & 1) << 1 | (intack & 1), readaddr])
         radio.wait_for_clear_to_send()
         data = radio.context.read_bytes(14)
-        confidence = [0] * 8
-        for i in range(0, 8):
-            confidence[i] = data[int((7 - i) / 4) + 4] >> (i % 4 * 2) & 0x3
+        confidence = list(_SAME_CONFIDENCE[data[5]] + _SAME_CONFIDENCE[data[4]])
 
         return {
             "EOMDET": (data[1] & 8) != 0,
@@ -467,6 +497,27 @@ class SetAGCStatus(CommandRequiringPowerUp):
         radio.wait_for_clear_to_send()
 
 
+class CommandBatch(Command):
+    """
+    Several commands executed together, one after another, with one future for the lot.  The result is a list of
+    their results.  If one fails, the batch fails with its exception and the rest aren't executed.
+    """
+
+    def __init__(self, commands):
+        super(CommandBatch, self).__init__(mnemonic="BATCH")
+        self.commands = list(commands)
+
+    def do_command0(self, radio):
+        results = []
+        for command in self.commands:
+            command.do_command(radio)  # raises if it fails
+            results.append(command.result)
+        return results
+
+    def get_priority(self):
+        return min([c.get_priority() for c in self.commands] or [super(CommandBatch, self).get_priority()])
+
+
 class Callback(Command):
     """
     As a convenience to call a function from the command queue (to change an LED or a relay which might
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# Ways of waiting for the Si4707 to be clear to send (CTS)
+#
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Every read of the status is a transaction on an I2C bus that may be shared with other devices, so these try
+# to read it as few times as they can without keeping the command waiting much longer than it takes.
+import time
+
+
+class CTSPolling(object):
+    """
+    Read the status until it shows CTS, sleeping in between - first for most of the time the command usually takes,
+    then for exponentially longer.  The usual time for each command is learned as it goes.
+    """
+
+    def __init__(self, initial_sec=.002, min_sleep_sec=.00025, max_sleep_sec=.016):
+        """
+        :param initial_sec: the time to assume a command takes before it has been seen
+        :param min_sleep_sec: the shortest to sleep between reads
+        :param max_sleep_sec: the longest to sleep between reads
+        """
+        self.initial_sec = initial_sec
+        self.min_sleep_sec = min_sleep_sec
+        self.max_sleep_sec = max_sleep_sec
+        self.__typical = {}  # key: moving average of the seconds to CTS
+
+    def typical_sec(self, key):
+        """
+        :return: about how long the command usually takes to be clear to send
+        """
+        return self.__typical.get(key, self.initial_sec)
+
+    def wait(self, radio, key, expiry):
+        """
+        :param radio: the Si4707, to read the status from
+        :param key: the name of the command being waited for
+        :param expiry: the time.time() at which to give up, None to wait indefinitely
+        :return: the status showing CTS, or None if the time ran out first
+        """
+        start = time.time()
+        typical = self.typical_sec(key)
+        # Sleep for less than the usual time at first, so that the average can come down as well as go up
+        sleep = typical * .75
+        while True:
+            status = radio._read_status()
+            now = time.time()
+            if status.is_clear_to_send():
+                if now > start or key in self.__typical:
+                    self.__typical[key] = typical * .875 + (now - start) * .125
+                return status
+            if expiry is not None and now >= expiry:
+                return None
+            sleep = min(max(sleep, self.min_sleep_sec), self.max_sleep_sec)
+            if expiry is not None:
+                sleep = min(sleep, expiry - now)
+            time.sleep(sleep)
+            sleep *= 2
+
+
+class CTSInterrupt(object):
+    """
+    Wait for the interrupt the radio raises with CTS (when it was powered up with cts_interrupt_enable), reading the
+    status only when it comes.  In case one goes astray, it reads the status anyway every so often, at exponentially
+    longer intervals.
+
+    The radio's context must have an interrupt line.  Interrupts other than CTS that come while waiting are passed
+    along to the command loop.
+    """
+
+    def __init__(self, min_wait_sec=.005, max_wait_sec=.1, edge_wait_sec=.02):
+        """
+        :param min_wait_sec: the longest to wait for an interrupt before reading the status the first time
+        :param max_wait_sec: the longest to wait for an interrupt before reading the status anyway
+        :param edge_wait_sec: the longest to wait for the interrupt that comes with CTS once the status shows it
+        """
+        self.min_wait_sec = min_wait_sec
+        self.max_wait_sec = max_wait_sec
+        self.edge_wait_sec = edge_wait_sec
+
+    def wait(self, radio, key, expiry):
+        """
+        As for CTSPolling.wait
+        """
+        context = radio.context
+        consumed = False
+        wait = self.min_wait_sec
+        while True:
+            consumed |= context.wait_for_interrupt(0)
+            status = radio._read_status()
+            if status.is_clear_to_send():
+                if not consumed:
+                    # The interrupt that comes with CTS can arrive after the status shows CTS when the context gets it
+                    # on a thread of its own (as from a GPIO callback).  Take it here, or it would wake the command
+                    # loop for nothing - and the interrupts checked then would bring another.
+                    edge_expiry = time.time() + self.edge_wait_sec
+                    while not consumed and time.time() < edge_expiry:
+                        consumed = context.wait_for_interrupt(edge_expiry - time.time())
+                if consumed and status.is_interrupt():
+                    context.interrupt()  # Something else interrupted; leave it for the command loop
+                return status
+            now = time.time()
+            if expiry is not None and now >= expiry:
+                return None
+            consumed |= context.wait_for_interrupt(wait if expiry is None else min(wait, expiry - now))
+            wait = min(wait * 2, self.max_wait_sec)
@@ -47,10 +47,16 @@ class SAMEMessageReceivedEvent(SAMEEvent):
 
 
 class SAMEHeaderReceived(SAMEEvent):
-    def __init__(self, message):
+    def __init__(self, message, frame=None):
+        """
+        :param message: the SAMEMessage the header was added to
+        :param frame: a tuple of the distance from the expected end of a header and the most likely length of
+           this header, as from SAME.FrameDetector.best(), or None if it's not known
+        """
         super(SAMEHeaderReceived, self).__init__()
         self.message = message
         self.header = message.headers[-1]
+        self.frame = frame
 
     def __str__(self):
         return "SAMEHeaderReceived: %s" % str(self.header)
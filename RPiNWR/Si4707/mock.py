@@ -40,6 +40,8 @@ class MockContext(Context):
     # This mock includes an i2c facade because of how it came to be.
     # It would be nice to remove that feature...
     # TODO split out the I2C mock, Context, and the Si4707 mock
+    has_interrupt_line = True
+
     def write_bytes(self, data):
         if len(data) == 1:
             self.write8(data[0], 0)
@@ -50,7 +52,7 @@ class MockContext(Context):
         return self.readList(0, num_bytes)
 
     def reset_radio(self):
-        self.__init__()
+        self.__reset()
 
     @staticmethod
     def getPiRevision():
@@ -67,6 +69,21 @@ class MockContext(Context):
         pass
 
     def __init__(self):
+        super(MockContext, self).__init__()
+        self.__reset()
+
+    @property
+    def interrupts(self):
+        return self.__interrupts
+
+    @interrupts.setter
+    def interrupts(self, value):
+        raised = value & ~self.__interrupts
+        self.__interrupts = value
+        if raised:
+            self.interrupt()  # as the chip would pull down its interrupt line
+
+    def __reset(self):
         self.bus = {
             0: [0] * 5
         }
@@ -76,7 +93,8 @@ class MockContext(Context):
         self.OPMODE = 0  # 5 = Analog audio,
         self.props = dict([(x[0], x[3]) for x in PROPERTIES])
         self.power = False
-        self.interrupts = 0
+        self.__interrupts = 0
+        self.CTSIEN = 0
         self.asq_stopped = False
         self.asq_started = False
         self.asq_tone = False
@@ -147,6 +165,8 @@ class MockContext(Context):
             self.power = False
         elif reg == 0x12:  # SET_PROPERTY
             self.props[struct.unpack(">H", bytes(self.bus[reg][1:3]))] = struct.unpack(">H", bytes(self.bus[reg][3:5]))
+            if struct.unpack(">H", bytes(self.bus[reg][1:3]))[0] == 0x0001:  # GPO_IEN
+                self.CTSIEN = self.bus[reg][4] >> 7  # the low byte of the value
             self.set_signal_quality()  # Check if the thresholds have been crossed
         elif reg == 0x13:  # GET_PROPERTY
             prop = struct.unpack(">H", bytes(self.bus[reg][1:3]))[0]
@@ -220,6 +240,9 @@ class MockContext(Context):
             logging.error("Command not mocked 0x%02X" % reg)
             self.registers[0][0] = 192
 
+        if self.CTSIEN:
+            self.interrupt()  # CTS comes right away here, and with it the interrupt
+
     def alert_tone(self, playing=False):
         with self.asq_lock:
             if self.asq_tone != playing:
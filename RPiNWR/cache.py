@@ -18,9 +18,137 @@ __author__ = 'ke4roh'
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import threading
 import functools
+import logging
 import time
 import re
 from shapely.geometry import Point
+from shapely.strtree import STRtree
+from RPiNWR.CAP import CAPMessage
+from RPiNWR.SAME import SAMEMessage
+from RPiNWR.metrics import Metrics, SIZE_BUCKETS
+
+
+class _GeometryTree(object):
+    """
+    An STRtree of some geometries, queried for their indices whichever version of shapely is at hand
+    """
+
+    def __init__(self, geometries):
+        self.geometries = list(geometries)
+        self.__tree = STRtree(self.geometries)
+        self.__index = None
+
+    def query(self, geometry):
+        """
+        :return: the indices of the geometries whose bounding boxes intersect that of the given geometry
+        """
+        hits = self.__tree.query(geometry)
+        if len(hits) and hasattr(hits[0], "geom_type"):  # shapely 1.x returns the geometries, 2.x their indices
+            if self.__index is None:
+                self.__index = dict([(id(g), i) for i, g in enumerate(self.geometries)])
+            hits = list([self.__index[id(g)] for g in hits])
+        return hits
+
+
+def _has_ended(holder, when):
+    """
+    For an expiration called by the sweeper when an event might have expired.  Later messages may have extended it,
+    in which case it stays (and there is another expiration scheduled for it).
+
+    :param holder: the EventMessageGroup for the event, None if it's already gone
+    :return: True if the event has ended and should be evicted
+    """
+    if holder is None:
+        return False
+    end = holder.get_end_time_sec()
+    return end is not None and end <= when
+
+
+def messages_containing(points, messages):
+    """
+    Test many points against the polygons of many messages at once.  Each point is only tested against the
+    polygons whose bounding boxes contain it.
+
+    :param points: a list of tuples of latitude and longitude
+    :param messages: CAPMessages (or others with polygon and get_prepared_polygon)
+    :return: a list with, for each point, a list of the messages whose polygons contain it
+    """
+    messages = list([m for m in messages if m.polygon is not None])
+    if not len(messages):
+        return list([[] for p in points])
+    tree = _GeometryTree([m.polygon for m in messages])
+    result = []
+    for latlon in points:
+        point = Point(*latlon)
+        found = []
+        for hit in tree.query(point):
+            m = messages[hit]
+            if m.get_prepared_polygon().contains(point):
+                found.append(m)
+        result.append(found)
+    return result
+
+
+class FIPSIndex(object):
+    """
+    Keys (such as event IDs) indexed by the FIPS codes of their areas, to find the ones that might apply to a county
+    without checking each of them.  Lookups match codes as applies_to_fips does: P-code 0 means the whole county,
+    which includes every part of it.
+    """
+
+    def __init__(self):
+        self.__keys = {}  # county (the FIPS code without its P component): {P-code: set of keys}
+        self.__areas = {}  # key: set of the FIPS codes it was added with
+        self.__order = {}  # key: serial number, to return keys in the order they were added
+        self.__serial = 0
+
+    def add(self, key, areas):
+        """
+        :param key: what to find
+        :param areas: FIPS codes for it, in addition to any it was already added with
+        """
+        if key not in self.__areas:
+            self.__serial += 1
+            self.__order[key] = self.__serial
+        codes = self.__areas.setdefault(key, set())
+        for fips in areas or []:
+            if len(fips) == 5:
+                fips = '0' + fips
+            if len(fips) and fips not in codes:
+                codes.add(fips)
+                self.__keys.setdefault(fips[1:], {}).setdefault(fips[0], set()).add(key)
+
+    def remove(self, key):
+        self.__order.pop(key, None)
+        for fips in self.__areas.pop(key, []):
+            subdivisions = self.__keys[fips[1:]]
+            subdivisions[fips[0]].discard(key)
+            if not len(subdivisions[fips[0]]):
+                del subdivisions[fips[0]]
+                if not len(subdivisions):
+                    del self.__keys[fips[1:]]
+
+    def lookup(self, fips):
+        """
+        :param fips: a FIPS code, with or without its P component
+        :return: a list of the keys having a code that matches it, in the order they were added
+        """
+        if len(fips) == 5:
+            fips = '0' + fips
+        if len(fips) != 6:
+            raise ValueError()
+        subdivisions = self.__keys.get(fips[1:], {})
+        if fips.startswith('0'):
+            keys = set().union(*subdivisions.values())
+        else:
+            keys = subdivisions.get(fips[0:1], set()) | subdivisions.get('0', set())
+        return sorted(keys, key=self.__order.get)
+
+    def __iter__(self):
+        return iter(list(self.__areas.keys()))
+
+    def __len__(self):
+        return len(self.__areas)
 
 
 class MessageCache(object):
@@ -36,28 +164,79 @@ class MessageCache(object):
     Collaborators:
     A message source, either Si4707 or other message retriever
     A consumer, to monitor the messages
+    An ExpirySweeper (optional), to evict messages as they expire
     """
 
     # TODO track the time since last received message for my fips, alert if >8 days
     # TODO monitor RSSI & SNR and alert if out of spec (what is spec)?
-    def __init__(self, latlon, county_fips, sorter):
+    def __init__(self, latlon, county_fips, sorter, sweeper=None):
+        """
+        :param latlon: the point of interest
+        :param county_fips: the county containing the point of interest
+        :param sorter: a comparator for putting messages in priority order
+        :param sweeper: an ExpirySweeper to evict events as they expire, None to leave them until clear_inactive
+        """
         self.__messages_lock = threading.Lock()
         self.__messages = {}
-        self.__local_messages = []
+        self.__fips_index = FIPSIndex()  # event IDs by the areas of their messages
         self.latlon = latlon
         self.county_fips = county_fips
         self.sorter = sorter
-        # TODO add cleanup daemon thread to sweep every so often for expired messages
+        self.sweeper = sweeper
+        self.metrics = Metrics({"query_results": SIZE_BUCKETS})
+
+    def stats(self):
+        """
+        :return: a dict of the counts of messages added, duplicates rejected, events evicted and queries, and
+           histograms (as from RPiNWR.metrics.Histogram.to_dict) of the seconds spent waiting for the lock, and of
+           the seconds taken by, seconds spent sorting in, and number of events returned by get_active_messages.
+           RPiNWR.metrics.to_prometheus will format it for Prometheus.
+        """
+        return self.metrics.stats()
+
+    def __acquire(self):
+        """
+        Take the lock, noting how long it took
+        """
+        start = time.perf_counter()
+        self.__messages_lock.acquire()
+        self.metrics.observe("lock_wait_seconds", time.perf_counter() - start)
 
     def add_message(self, message):
-        with self.__messages_lock:
+        self.__acquire()
+        try:
             collection = self.__messages
             if message.event_id not in collection:
                 holder = EventMessageGroup()
                 collection[message.event_id] = holder
             else:
                 holder = collection[message.event_id]
-            holder.add_message(message)
+            if holder.add_message(message):
+                self.metrics.count("added")
+            else:
+                self.metrics.count("duplicates")
+            self.__fips_index.add(message.event_id, message.get_areas())
+            end = holder.get_end_time_sec()
+        finally:
+            self.__messages_lock.release()
+        if self.sweeper is not None and end is not None:
+            self.sweeper.schedule(end, functools.partial(self.__expire, message.event_id))
+
+    def __expire(self, event_id, when):
+        """
+        :return: a list of the EventMessageGroup if it was evicted (see _has_ended), otherwise an empty list
+        """
+        self.__acquire()
+        try:
+            holder = self.__messages.get(event_id)
+            if not _has_ended(holder, when):
+                return []
+            del self.__messages[event_id]
+            self.__fips_index.remove(event_id)
+        finally:
+            self.__messages_lock.release()
+        self.metrics.count("evicted")
+        return [holder]
 
     def get_active_messages(self, when=None, event_pattern=None, here=True):
         """
@@ -65,6 +244,46 @@ class MessageCache(object):
         :param event_pattern: a regular expression to match the desired event codes.  default = all.
         :param here: True to retrieve local messages, False to retrieve those for other locales
         """
+        start = time.perf_counter()
+        if when is None:
+            when = time.time()
+        if event_pattern is None:
+            event_pattern = re.compile(".*")
+        elif not hasattr(event_pattern, 'match'):
+            event_pattern = re.compile(event_pattern)
+
+        l = list(filter(lambda m: event_pattern.match(m.get_event_type()), self.__active(when, here)))
+        sort_start = time.perf_counter()
+        l.sort(key=functools.cmp_to_key(self.sorter))
+        end = time.perf_counter()
+        self.metrics.count("queries")
+        self.metrics.observe("query_seconds", end - start)
+        self.metrics.observe("sort_seconds", end - sort_start)
+        self.metrics.observe("query_results", len(l))
+        return l
+
+    def __active(self, when, here):
+        """
+        :return: the EventMessageGroups effective at the time, here or elsewhere, in no particular order
+        """
+        if here and self.county_fips:
+            # Only events with a message for this county can be effective here
+            messages = self.__messages
+            candidates = [messages[x] for x in self.__fips_index.lookup(self.county_fips) if x in messages]
+        else:
+            candidates = self.__messages.values()
+        return list([m for m in candidates if m.is_effective(self.latlon, self.county_fips, here, when)])
+
+    def get_events_at(self, points, when=None, event_pattern=None):
+        """
+        Find the events with polygons containing each of many points, such as the locations of subscribers.  This
+        considers only polygons, not counties.
+
+        :param points: a list of tuples of latitude and longitude
+        :param when: the time for which to check effectiveness of the messages, default = the present time
+        :param event_pattern: a regular expression to match the desired event codes.  default = all.
+        :return: a list with, for each point, a list of the EventMessageGroups in effect there, in priority order
+        """
         if when is None:
             when = time.time()
         if event_pattern is None:
@@ -72,14 +291,363 @@ class MessageCache(object):
         elif not hasattr(event_pattern, 'match'):
             event_pattern = re.compile(event_pattern)
 
-        l = list(filter(lambda m: m.is_effective(self.latlon, self.county_fips, here, when) and event_pattern.match(
-            m.get_event_type()), self.__messages.values()))
+        containers = {}
+        events = {}  # id of container: the groups it's the latest message for (one per VTEC code)
+        for group in list(self.__messages.values()):
+            container = group.get_polygon_message(when)
+            if container is not None and event_pattern.match(group.get_event_type()):
+                containers[id(container)] = container
+                events.setdefault(id(container), []).append(group)
+
+        result = []
+        for found in messages_containing(points, containers.values()):
+            l = list([group for c in found for group in events[id(c)]])
+            l.sort(key=functools.cmp_to_key(self.sorter))
+            result.append(l)
+        return result
+
+    def clear_inactive(self, when=None):
+        self.__acquire()
+        try:
+            if when is None:
+                when = time.time()
+            active = self.__active(when, True) + self.__active(when, False)
+            evicted = len(self.__messages) - len(active)
+            self.__messages = dict([(m.get_event_id(), m) for m in active])
+            for event_id in list([x for x in self.__fips_index if x not in self.__messages]):
+                self.__fips_index.remove(event_id)
+        finally:
+            self.__messages_lock.release()
+        self.metrics.count("evicted", evicted)
+
+    def snapshot(self, when=None):
+        """
+        :param when: the time of the snapshot, default = the present time
+        :return: the messages, as simple types (for JSON, as by RPiNWR.snapshot.write_snapshot), for restore.  VTEC
+           messages are saved by way of their CAP containers, each of which is saved once.
+        """
+        if when is None:
+            when = time.time()
+        containers = []
+        container_ix = {}
+        messages = []
+        self.__acquire()
+        try:
+            for group in list(self.__messages.values()):
+                for m in group.messages:
+                    container = getattr(m, "container", None)
+                    if isinstance(container, CAPMessage):
+                        if id(container) not in container_ix:
+                            container_ix[id(container)] = len(containers)
+                            containers.append(container.to_dict())
+                        messages.append(["CAP", container_ix[id(container)], list(container.vtec).index(m)])
+                    else:
+                        messages.append(["SAME", m.to_dict()])
+        finally:
+            self.__messages_lock.release()
+        return {"kind": "MessageCache", "time": when, "containers": containers, "messages": messages}
+
+    def restore(self, snapshot, when=None):
+        """
+        Add the messages from a snapshot, leaving out the events that have ended.
+
+        :param snapshot: as from snapshot
+        :param when: the time from which to judge the events ended, default = the present time
+        :return: the number of messages restored
+        """
+        if snapshot.get("kind") != "MessageCache":
+            raise ValueError("Not a MessageCache snapshot: %s" % snapshot.get("kind"))
+        if when is None:
+            when = time.time()
+        containers = list([CAPMessage.from_dict(d) for d in snapshot["containers"]])
+        messages = []
+        for m in snapshot["messages"]:
+            if m[0] == "CAP":
+                messages.append(containers[m[1]].vtec[m[2]])
+            else:
+                messages.append(SAMEMessage.from_dict(m[1]))
+
+        # An event ends with its last message
+        ends = {}
+        for m in messages:
+            ends[m.event_id] = m.get_end_time_sec()
+        restored = 0
+        for m in messages:
+            if ends[m.event_id] is None or ends[m.event_id] > when:
+                self.add_message(m)
+                restored += 1
+        return restored
+
+
+class SubscriberAlerts(object):
+    """
+    The alerts in effect for a subscriber changed.
+    """
+
+    def __init__(self, subscriber_id, gained, lost, t):
+        """
+        :param subscriber_id: the subscriber
+        :param gained: a list of the EventMessageGroups that came into effect for the subscriber
+        :param lost: a list of the EventMessageGroups that are no longer in effect for the subscriber
+        :param t: the time at which effectiveness was evaluated
+        """
+        self.subscriber_id = subscriber_id
+        self.gained = gained
+        self.lost = lost
+        self.time = t
+
+    def __str__(self):
+        return "Alerts for %s: +[%s] -[%s]" % (self.subscriber_id, ",".join([str(x.get_event_id()) for x in self.gained]),
+                                               ",".join([str(x.get_event_id()) for x in self.lost]))
+
+
+class SubscriberCache(object):
+    """
+    SubscriberCache holds a collection of messages, as MessageCache does, on behalf of many subscribers, each with
+    its own location and county.
+
+    Responsibilities:
+    0. Know its subscribers, indexed by county and location
+    1. Receive SAME or VTEC messages
+    2. Work out which subscribers gained or lost an alert with each message, checking only those in its area
+    3. Tell the callback about each subscriber's changes
+    4. Provide a list of effective messages for a subscriber in priority order
+
+    Collaborators:
+    A message source, either Si4707 or other message retriever
+    A consumer, to receive the changes for each subscriber
+    An ExpirySweeper (optional), to evict messages as they expire.  Without one, events that end between messages
+    are not noticed until clear_inactive is called.
+    """
+
+    def __init__(self, sorter, callback, sweeper=None):
+        """
+        :param sorter: a comparator for putting messages in priority order
+        :param callback: a function taking one parameter, a SubscriberAlerts, called for each subscriber whose
+           alerts changed
+        :param sweeper: an ExpirySweeper to evict events as they expire, None to leave them until clear_inactive
+        """
+        self.__lock = threading.Lock()
+        self.__messages = {}  # event_id: EventMessageGroup
+        self.__event_fips = FIPSIndex()  # event IDs by the areas of their messages
+        self.__subscribers = {}  # subscriber_id: (latlon, fips)
+        self.__subscriber_fips = FIPSIndex()  # subscriber IDs by their counties
+        self.__tree = None  # a _GeometryTree of the subscribers' locations, made when needed
+        self.__tree_ids = []  # the subscriber ID for each location in the tree
+        self.__alerts = {}  # subscriber_id: set of the event IDs in effect for the subscriber
+        self.__holders = {}  # event_id: set of the subscriber IDs for which it is in effect
+        self.__expired = {}  # event_id: EventMessageGroup, for events being evicted
+        self.sorter = sorter
+        self.callback = callback
+        self.sweeper = sweeper
+
+    def add_subscriber(self, subscriber_id, latlon, fips, when=None):
+        """
+        :param subscriber_id: something hashable to identify the subscriber
+        :param latlon: the subscriber's location, None if it's not known
+        :param fips: the county containing the subscriber
+        :param when: the time at which to evaluate the alerts already in effect, default = the present time
+        """
+        self.add_subscribers([(subscriber_id, latlon, fips)], when)
+
+    def add_subscribers(self, subscribers, when=None):
+        """
+        Add many subscribers at once, indexing their locations together rather than one at a time.
+
+        :param subscribers: tuples of subscriber_id, latlon, and fips, as for add_subscriber
+        :param when: the time at which to evaluate the alerts already in effect, default = the present time
+        """
+        if when is None:
+            when = time.time()
+        subscribers = list(subscribers)
+        with self.__lock:
+            candidates = {}  # event_id: set of the new subscribers in its counties
+            for subscriber_id, latlon, fips in subscribers:
+                self.__remove_subscriber(subscriber_id)
+                if latlon is not None:
+                    latlon = tuple(latlon)
+                    self.__tree = None
+                self.__subscribers[subscriber_id] = (latlon, fips)
+                self.__subscriber_fips.add(subscriber_id, [fips])
+                self.__alerts[subscriber_id] = set()
+                for event_id in self.__event_fips.lookup(fips):
+                    candidates.setdefault(event_id, set()).add(subscriber_id)
+            changes = {}
+            # Just one is quicker to test by itself than by rebuilding the index of everyone's locations
+            use_tree = len(subscribers) > 1
+            for event_id, new_subscribers in candidates.items():
+                self.__update(event_id, new_subscribers, when, changes, use_tree)
+        self.__notify(changes, when)
+
+    def remove_subscriber(self, subscriber_id):
+        with self.__lock:
+            self.__remove_subscriber(subscriber_id)
+
+    def __remove_subscriber(self, subscriber_id):
+        if subscriber_id not in self.__subscribers:
+            return
+        latlon, fips = self.__subscribers.pop(subscriber_id)
+        self.__subscriber_fips.remove(subscriber_id)
+        for event_id in self.__alerts.pop(subscriber_id):
+            self.__holders[event_id].discard(subscriber_id)
+        if latlon is not None:
+            self.__tree = None
+
+    def add_message(self, message, when=None):
+        """
+        :param message: the message to add
+        :param when: the time at which to evaluate its effectiveness, default = the present time
+        """
+        if when is None:
+            when = time.time()
+        with self.__lock:
+            if message.event_id not in self.__messages:
+                holder = EventMessageGroup()
+                self.__messages[message.event_id] = holder
+            else:
+                holder = self.__messages[message.event_id]
+            holder.add_message(message)
+            self.__event_fips.add(message.event_id, message.get_areas())
+            changes = {}
+            self.__update(message.event_id, self.__candidates(holder), when, changes)
+            end = holder.get_end_time_sec()
+        if self.sweeper is not None and end is not None:
+            self.sweeper.schedule(end, functools.partial(self.__expire, message.event_id))
+        self.__notify(changes, when)
+
+    def __candidates(self, holder):
+        """
+        :return: a set of the subscribers for whom the event might be in effect - those in its counties, plus those
+           for whom it is in effect already
+        """
+        candidates = set(self.__holders.get(holder.get_event_id(), set()))
+        for fips in holder.areas:
+            candidates.update(self.__subscriber_fips.lookup(fips))
+        return candidates
+
+    def __update(self, event_id, candidates, when, changes, use_tree=True):
+        """
+        Work out whether the event is in effect for each of the candidates, and note any changes.
+
+        :param changes: a dict of subscriber_id: tuple of lists of gained and lost EventMessageGroups, to update
+        :param use_tree: True to find the subscribers within a polygon by the index of all their locations (made
+           again if it's out of date), False to test each candidate's location by itself
+        """
+        holder = self.__messages.get(event_id)
+        by_fips = {}
+        for subscriber_id in candidates:
+            by_fips.setdefault(self.__subscribers[subscriber_id][1], []).append(subscriber_id)
+
+        effective = set()
+        for fips, subscribers in by_fips.items():
+            latest = holder and holder.get_effective_message(fips, when)
+            if latest is None:
+                continue
+            prepared = None
+            try:
+                prepared = latest.container.get_prepared_polygon()
+            except AttributeError:
+                pass
+            if prepared is None:
+                effective.update(subscribers)
+            else:
+                effective.update([x for x in subscribers if self.__subscribers[x][0] is None])
+                if use_tree:
+                    within = self.__within(latest.container.polygon, prepared)
+                    effective.update([x for x in subscribers if x in within])
+                else:
+                    effective.update([x for x in subscribers if self.__subscribers[x][0] is not None and
+                                      prepared.contains(Point(*self.__subscribers[x][0]))])
+
+        holders = self.__holders.setdefault(event_id, set())
+        for subscriber_id in candidates:
+            if (subscriber_id in effective) != (subscriber_id in holders):
+                gained, lost = changes.setdefault(subscriber_id, ([], []))
+                if subscriber_id in effective:
+                    holders.add(subscriber_id)
+                    self.__alerts[subscriber_id].add(event_id)
+                    gained.append(holder)
+                else:
+                    holders.discard(subscriber_id)
+                    self.__alerts[subscriber_id].discard(event_id)
+                    lost.append(self.__expired.get(event_id, holder))
+        if not len(holders):
+            del self.__holders[event_id]
+
+    def __within(self, polygon, prepared):
+        """
+        :return: a set of the IDs of the subscribers located within the polygon
+        """
+        if self.__tree is None:
+            located = list([(k, v[0]) for k, v in self.__subscribers.items() if v[0] is not None])
+            self.__tree_ids = list([k for k, latlon in located])
+            self.__tree = _GeometryTree([Point(*latlon) for k, latlon in located]) if len(located) else False
+        if not self.__tree:
+            return set()
+        points = self.__tree.geometries
+        return set([self.__tree_ids[i] for i in self.__tree.query(polygon) if prepared.contains(points[i])])
+
+    def __expire(self, event_id, when):
+        """
+        :return: a list of the EventMessageGroup if it was evicted (see _has_ended), otherwise an empty list
+        """
+        with self.__lock:
+            holder = self.__messages.get(event_id)
+            if not _has_ended(holder, when):
+                return []
+            changes = {}
+            self.__evict(event_id, when, changes)
+        self.__notify(changes, when)
+        return [holder]
+
+    def __evict(self, event_id, when, changes):
+        holder = self.__messages.pop(event_id)
+        self.__event_fips.remove(event_id)
+        self.__expired[event_id] = holder
+        try:
+            self.__update(event_id, set(self.__holders.get(event_id, set())), when, changes)
+        finally:
+            del self.__expired[event_id]
+
+    def get_active_messages(self, subscriber_id, event_pattern=None):
+        """
+        :param subscriber_id: the subscriber
+        :param event_pattern: a regular expression to match the desired event codes.  default = all.
+        :return: the EventMessageGroups in effect for the subscriber as of the last change, in priority order
+        """
+        if event_pattern is None:
+            event_pattern = re.compile(".*")
+        elif not hasattr(event_pattern, 'match'):
+            event_pattern = re.compile(event_pattern)
+        with self.__lock:
+            l = list([self.__messages[x] for x in self.__alerts.get(subscriber_id, set())])
+        l = list(filter(lambda m: event_pattern.match(m.get_event_type()), l))
         l.sort(key=functools.cmp_to_key(self.sorter))
         return l
 
     def clear_inactive(self, when=None):
-        with self.__messages_lock:
-            self.__messages = self.get_active_messages(when)
+        """
+        Check every event again at the given time, telling the callback about any changes, and drop the events
+        that have ended.
+        """
+        if when is None:
+            when = time.time()
+        with self.__lock:
+            changes = {}
+            for event_id, holder in list(self.__messages.items()):
+                end = holder.get_end_time_sec()
+                if end is not None and end < when:
+                    self.__evict(event_id, when, changes)
+                else:
+                    self.__update(event_id, self.__candidates(holder), when, changes)
+        self.__notify(changes, when)
+
+    def __notify(self, changes, when):
+        for subscriber_id, (gained, lost) in changes.items():
+            try:
+                self.callback(SubscriberAlerts(subscriber_id, gained, lost, when))
+            except Exception:
+                logging.getLogger(type(self).__name__).exception("notifying %s", subscriber_id)
 
 
 class EventMessageGroup(object):
@@ -92,16 +660,56 @@ class EventMessageGroup(object):
     def __init__(self):
         self.messages = []
         self.areas = set([])
+        # Derived from the messages as they are added, so that effectiveness is a lookup rather than a search:
+        self.__times = []  # (published, start, end or inf, message) for each message, in the order added
+        self.__by_fips = {}  # fips: the __times entries for messages applying to it, made when first asked for
+        self.__window = None  # (earliest published, latest end) of all the messages
 
     def add_message(self, msg):
+        """
+        :return: True if the message was added, False if it was a duplicate
+        """
         if len(self.messages):
             assert msg.event_id == self.get_event_id()
             if msg in self.messages:
-                return
+                return False
         self.messages.append(msg)
         self.areas.update(msg.get_areas())
         # Maybe handle corrections by replacing, maybe just leave them in as historical record
 
+        end = msg.get_end_time_sec()
+        if end is None:
+            end = float("inf")  # until further notice
+        entry = (msg.published, msg.get_start_time_sec(), end, msg)
+        self.__times.append(entry)
+        for fips, entries in self.__by_fips.items():
+            if msg.applies_to_fips(fips):
+                entries.append(entry)
+        if self.__window is None:
+            self.__window = (entry[0], entry[2])
+        else:
+            self.__window = (min(self.__window[0], entry[0]), max(self.__window[1], entry[2]))
+        return True
+
+    @staticmethod
+    def __in_effect(entry, when):
+        published, start, end, msg = entry
+        return published <= when < end and (start is None or start <= when)
+
+    def __latest(self, entries, when):
+        """
+        :param entries: a list of __times entries in the order added
+        :return: the last of the entries in effect at the time, or None
+        """
+        if not entries or self.__window[0] > when or self.__window[1] <= when:
+            return None
+        if self.__in_effect(entries[-1], when):
+            return entries[-1][3]  # the usual case, asking about the present
+        for entry in reversed(entries[:-1]):
+            if self.__in_effect(entry, when):
+                return entry[3]
+        return None
+
     def get_event_id(self):
         if len(self.messages):
             return self.messages[0].event_id
@@ -134,22 +742,20 @@ class EventMessageGroup(object):
         else:
             when + 0  # fail if it's not numeric
 
-        # Get all the messages for the county
-        # TODO make this work if they're zones, too.
-        cm = list(filter(lambda m: m.applies_to_fips(fips) and m.published <= when and
-                                   (m.get_end_time_sec() > when and
-                                    (m.get_start_time_sec() is None or m.get_start_time_sec() <= when)), self.messages))
+        # Get the latest message for the county
+        latest = self.get_effective_message(fips, when)
 
         # If it has a polygon, does it apply here?
-        its_here = len(cm)
+        its_here = latest is not None
         polygon = None
         if its_here and latlon:
             try:
-                polygon = cm[-1].container.polygon
+                container = latest.container
+                polygon = container.polygon
             except AttributeError:
                 polygon = None
 
-            its_here = (not polygon or polygon.contains(Point(*latlon)))
+            its_here = (not polygon or container.polygon_contains(latlon))
 
         if here:
             return its_here
@@ -160,11 +766,38 @@ class EventMessageGroup(object):
                 return False
             else:
                 # check neighboring areas
-                for a in filter(lambda x: x != fips, self.areas):
-                    if self.is_effective(None, a, True, when):
+                for a in self.areas:
+                    if a != fips and self.get_effective_message(a, when) is not None:
                         return True
         return False
 
+    def get_effective_message(self, fips, when):
+        """
+        :param fips: the county
+        :param when: The time at which to evaluate
+        :return: the latest message for the county in effect at the time, None if there is none
+        """
+        try:
+            entries = self.__by_fips[fips]
+        except KeyError:
+            # TODO make this work if they're zones, too.
+            entries = self.__by_fips[fips] = list([x for x in self.__times if x[3].applies_to_fips(fips)])
+        return self.__latest(entries, when)
+
+    def get_polygon_message(self, when=None):
+        """
+        :param when: The time at which to evaluate, default= now
+        :return: the container (such as a CAPMessage) of the latest message in effect at that time, if it has a
+           polygon, otherwise None
+        """
+        if when is None:
+            when = time.time()
+        m = self.__latest(self.__times, when)
+        container = getattr(m, "container", None)
+        if getattr(container, "polygon", None) is not None:
+            return container
+        return None
+
     def get_start_time_sec(self):
         return self.messages[0].get_start_time_sec()
 
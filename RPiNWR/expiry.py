@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# Evict messages from caches as they expire
+#
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import heapq
+import logging
+import threading
+import time
+
+
+class AlertExpired(object):
+    def __init__(self, msg, t):
+        self.message = msg
+        self.time = t
+
+    def __str__(self):
+        return "Expired: " + str(self.message)
+
+
+class ExpirySweeper(object):
+    """
+    This class keeps the expiration times of messages in caches, and from one daemon thread, tells each cache to
+    evict its messages as they expire, calling the callback with an AlertExpired for each one evicted.  One
+    sweeper can serve any number of caches.
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: a function taking one parameter, an AlertExpired, or None for no notification
+        """
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.callback = callback
+        self.stop = False
+        self.__expirations = []  # a heap of tuples of time, serial number, and function to call at that time
+        self.__serial = 0
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__sweeper, daemon=True)
+        self.__thread.start()
+
+    def schedule(self, when, expire):
+        """
+        :param when: the time.time() at which to expire
+        :param expire: a function taking the time at which it was scheduled and returning a list of the messages
+           it evicted (which may be empty if, for example, the message was already gone or has been extended)
+        """
+        with self.__condition:
+            self.__serial += 1
+            heapq.heappush(self.__expirations, (when, self.__serial, expire))
+            self.__condition.notify()
+
+    def close(self):
+        """
+        Stop sweeping.
+        """
+        with self.__condition:
+            self.stop = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __len__(self):
+        return len(self.__expirations)
+
+    def __sweeper(self):
+        while not self.stop:
+            due = []
+            with self.__condition:
+                while not self.stop and not due:
+                    now = time.time()
+                    while len(self.__expirations) and self.__expirations[0][0] <= now:
+                        due.append(heapq.heappop(self.__expirations))
+                    if not due:
+                        self.__condition.wait(self.__expirations[0][0] - now if len(self.__expirations) else None)
+            for when, serial, expire in due:
+                try:
+                    for m in expire(when):
+                        if self.callback:
+                            self.callback(AlertExpired(m, when))
+                except Exception:
+                    self.__logger.exception("expiring")
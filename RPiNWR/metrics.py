@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# Count things and time them, to see where the time goes
+#
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import bisect
+import collections
+import threading
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+    """
+    Counts of observations falling at or below each of several bounds, as a Prometheus histogram
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        :param bounds: the upper bound of each bucket, in increasing order.  Another bucket holds the rest.
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        """
+        :return: the count, sum, and a list of tuples of upper bound and the cumulative count of observations
+           at or below it, ending with infinity and the count
+        """
+        buckets = []
+        n = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            n += count
+            buckets.append((bound, n))
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class Metrics(object):
+    """
+    A thread-safe collection of named counters and histograms
+    """
+
+    def __init__(self, histograms=None):
+        """
+        :param histograms: a dict of name to the bucket bounds of each histogram, which are made when first observed
+           (with LATENCY_BUCKETS for any not named here)
+        """
+        self.__lock = threading.Lock()
+        self.__counters = collections.OrderedDict()
+        self.__histograms = collections.OrderedDict()
+        self.__bounds = dict(histograms or {})
+
+    def count(self, name, n=1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.__lock:
+            try:
+                h = self.__histograms[name]
+            except KeyError:
+                h = self.__histograms[name] = Histogram(self.__bounds.get(name, LATENCY_BUCKETS))
+            h.observe(value)
+
+    def stats(self):
+        """
+        :return: a dict of each counter name to its count, and each histogram name to a dict as from
+           Histogram.to_dict
+        """
+        with self.__lock:
+            d = collections.OrderedDict(self.__counters)
+            for name, h in self.__histograms.items():
+                d[name] = h.to_dict()
+        return d
+
+
+def to_prometheus(stats, prefix):
+    """
+    :param stats: as from Metrics.stats
+    :param prefix: to put before each name, such as "rpinwr_samecache"
+    :return: the stats in the Prometheus text exposition format
+    """
+    lines = []
+    for name, value in stats.items():
+        metric = "%s_%s" % (prefix, name)
+        if hasattr(value, "get"):
+            lines.append("# TYPE %s histogram" % metric)
+            for bound, n in value["buckets"]:
+                lines.append('%s_bucket{le="%s"} %d' % (metric, "+Inf" if bound == float("inf") else repr(bound), n))
+            lines.append("%s_sum %r" % (metric, value["sum"]))
+            lines.append("%s_count %d" % (metric, value["count"]))
+        else:
+            lines.append("# TYPE %s_total counter" % metric)
+            lines.append("%s_total %d" % (metric, value))
+    return "\n".join(lines) + "\n"
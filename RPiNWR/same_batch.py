@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# Re-decode recorded SAME headers in bulk
+#
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Input is JSON lines, one message per line, as from SAMEMessage.to_dict() - that is, with "headers" and "time" -
+# plus an optional "transmitter" (null for unknown).  Output is JSON lines, one per input line and in the same order,
+# with the decoded "message" and "confidence", the "decode_sec" it took, and the "time" and "transmitter" carried over.
+#
+#   python3 -m RPiNWR.same_batch --transmitter WXL58 headers.jsonl > decoded.jsonl
+
+import argparse
+import functools
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from RPiNWR.SAME import average_message
+
+_logger = logging.getLogger("RPiNWR.same_batch")
+
+
+def decode(line, transmitter=None):
+    """
+    :param line: one line of JSON with the headers of a message
+    :param transmitter: the transmitter to assume if the line doesn't name one
+    :return: one line of JSON with the decoded message, or an "error" if it couldn't be decoded
+    """
+    try:
+        record = json.loads(line)
+        transmitter = record.get("transmitter") or transmitter
+        start = time.perf_counter()
+        message, confidence = average_message(record["headers"], transmitter)
+        result = {
+            "message": message,
+            "confidence": confidence,
+            "decode_sec": time.perf_counter() - start,
+            "time": record.get("time"),
+            "transmitter": transmitter
+        }
+    except Exception as e:
+        _logger.exception("decoding %s", line.strip())
+        result = {"error": "%s: %s" % (type(e).__name__, e)}
+    return json.dumps(result, ensure_ascii=False)
+
+
+def decode_all(lines, transmitter=None, processes=None, chunksize=16):
+    """
+    Decode lines across a pool of processes.  The lines are handed to the pool a window at a time, so that a long
+    file isn't all read into memory ahead of the decoding.
+
+    :param lines: an iterable of lines of JSON, as for decode.  Blank lines are skipped.
+    :param transmitter: the transmitter to assume for lines that don't name one
+    :param processes: how many processes to use, default = one per CPU
+    :param chunksize: how many lines to hand a process at once
+    :return: a generator of the decoded lines, in order
+    """
+    lines = filter(lambda x: x.strip(), lines)
+    window = (processes or os.cpu_count() or 1) * chunksize * 4
+    with multiprocessing.Pool(processes) as pool:
+        results = []
+        while True:
+            # Queue the next window before yielding this one, so that the processes are kept busy
+            batch = list(itertools.islice(lines, window))
+            following = pool.imap(functools.partial(decode, transmitter=transmitter), batch, chunksize)
+            yield from results
+            if not batch:
+                break
+            results = following
+
+
+def main(args=None):
+    clparser = argparse.ArgumentParser(description="Decode recorded SAME headers")
+    clparser.add_argument("input", nargs="?", default="-", help="JSON lines of headers, - for stdin (default)")
+    clparser.add_argument("--output", default="-", help="where to write the JSON lines, - for stdout (default)")
+    clparser.add_argument("--transmitter", default=None, help="for messages that don't name their transmitter")
+    clparser.add_argument("--processes", default=None, type=int)
+    clparser.add_argument("--chunksize", default=16, type=int)
+    args = clparser.parse_args(args)
+
+    fin = sys.stdin if args.input == "-" else open(args.input, "r", encoding="UTF-8")
+    fout = sys.stdout if args.output == "-" else open(args.output, "w", encoding="UTF-8")
+    try:
+        for result in decode_all(fin, args.transmitter, args.processes, args.chunksize):
+            fout.write(result)
+            fout.write("\n")
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# Save the contents of message caches to disk, so that a receiver can pick up where it left off
+#
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A snapshot is gzipped JSON, an object with the format and version (so that an incompatible file is refused rather
+# than misread) and whatever the cache put in it.  On startup:
+#
+#   cache = SAMECache(county)
+#   snapshot = read_snapshot("same.snapshot")
+#   if snapshot is not None:
+#       cache.restore(snapshot)
+#   writer = SnapshotWriter(cache, "same.snapshot")
+#   ...
+#   writer.close()  # saves it once more
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+
+SNAPSHOT_FORMAT = "RPiNWR.snapshot"
+SNAPSHOT_VERSION = 1
+
+
+def write_snapshot(filename, snapshot):
+    """
+    Write the snapshot so that the file always holds either the old one or the new one, even if the power fails.
+
+    :param filename: where to write it
+    :param snapshot: a dict of simple types (for JSON), as from a cache's snapshot method
+    """
+    d = dict(snapshot)
+    d["format"] = SNAPSHOT_FORMAT
+    d["version"] = SNAPSHOT_VERSION
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            with gzip.GzipFile(fileobj=f, mode="wb") as z:
+                z.write(json.dumps(d, separators=(",", ":"), ensure_ascii=False).encode("UTF-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filename)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def read_snapshot(filename):
+    """
+    :param filename: as for write_snapshot
+    :return: the snapshot, or None if there is no such file
+    :raises ValueError: if the file isn't a snapshot of this version
+    """
+    try:
+        with gzip.open(filename, "rb") as f:
+            d = json.loads(f.read().decode("UTF-8"))
+    except FileNotFoundError:
+        return None
+    except OSError as e:  # not gzipped
+        raise ValueError("%s is not a snapshot: %s" % (filename, e))
+    if not isinstance(d, dict) or d.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError("%s is not a snapshot" % filename)
+    if d.get("version") != SNAPSHOT_VERSION:
+        raise ValueError("%s is snapshot version %s, not %d" % (filename, d.get("version"), SNAPSHOT_VERSION))
+    return d
+
+
+class SnapshotWriter(object):
+    """
+    This class saves a snapshot of a cache from a daemon thread every so often, and once more when it is closed.
+    """
+
+    def __init__(self, cache, filename, interval_sec=60):
+        """
+        :param cache: something with a snapshot method, such as a MessageCache or SAMECache
+        :param filename: where to write the snapshots
+        :param interval_sec: how often to write them
+        """
+        self.__logger = logging.getLogger(self.__class__.__name__)
+        self.cache = cache
+        self.filename = filename
+        self.interval_sec = interval_sec
+        self.stop = False
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__writer, daemon=True)
+        self.__thread.start()
+
+    def write(self):
+        """
+        Save a snapshot now.
+        """
+        try:
+            write_snapshot(self.filename, self.cache.snapshot())
+        except Exception:
+            self.__logger.exception("writing %s", self.filename)
+
+    def close(self):
+        """
+        Stop the thread and save a last snapshot.
+        """
+        with self.__condition:
+            self.stop = True
+            self.__condition.notify()
+        self.__thread.join()
+        self.write()
+
+    def __writer(self):
+        while True:
+            with self.__condition:
+                if not self.stop:
+                    self.__condition.wait(self.interval_sec)
+                if self.stop:
+                    return
+            self.write()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# Measure how long it takes to decode SAME messages
+#
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Run from the top of the repository:
+#
+#   python3 -m benchmarks.decoder --save before.json
+#   (change the decoder)
+#   python3 -m benchmarks.decoder --compare before.json
+#
+# Every stage is timed once per message in tests/dirty_messages.json for each repetition, and reported as
+# p50/p99 per call along with the peak memory allocated (tracemalloc) by one call.  Comparing against a saved
+# run exits with status 1 if any stage got slower by more than the threshold.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import numpy
+import RPiNWR.SAME as SAME
+
+_DIRTY_MESSAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "tests",
+                               "dirty_messages.json")
+
+
+def load_messages(filename=_DIRTY_MESSAGES):
+    """
+    :return: a list of tuples of headers and transmitter
+    """
+    with open(filename, "r", encoding='UTF-8') as f:
+        return [(m["headers"], m["transmitter"]) for m in json.load(f)]
+
+
+def stages(headers, transmitter):
+    """
+    Prepare the inputs for each stage of decoding one message, so that only the stage itself is measured.
+
+    :return: a list of tuples of the stage name and a function taking no arguments to run it
+    """
+    bitstrue, bitsfalse = SAME._vote_bits(headers)
+    bit_weight = bitstrue - bitsfalse
+    chars = [chr(c) for c in numpy.packbits((bit_weight > 0)[:, ::-1], axis=1)[:, 0].tolist()]
+    confidences = numpy.abs(bit_weight).sum(axis=1).tolist()
+
+    msg, msg_confidences = SAME.average_message(headers, transmitter)
+    # As _average_votes searches the counties, with the transmitter's index and the median worked out beforehand
+    fips_index = SAME.get_decode_profile(transmitter).fips_index
+    median = SAME.__median(msg_confidences)
+
+    def reconcile_fips():
+        m, c = msg, msg_confidences
+        for ix in range(10, len(m) - 23, 7):
+            m, c, matched = SAME._reconcile_word(m, c, ix, fips_index, median)
+
+    def end_to_end():
+        message = SAME.SAMEMessage(transmitter, headers)
+        message.get_SAME_message()
+        message.get_counties()
+        message.get_end_time_sec()
+
+    return [
+        ("average_message", lambda: SAME.average_message(headers, transmitter)),
+        ("_truncate", lambda: SAME._truncate(list(chars), list(confidences))),
+        ("_reconcile_word", reconcile_fips),
+        ("SAMEMessage", end_to_end)
+    ]
+
+
+def percentile(sorted_values, p):
+    """
+    :param sorted_values: the values, in order
+    :param p: 0-100
+    :return: the nearest-rank percentile
+    """
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values))) - 1))]
+
+
+def run(messages, repeat=20):
+    """
+    :param messages: as from load_messages
+    :param repeat: how many times to time each stage for each message
+    :return: a dict of stage name to a dict of statistics
+    """
+    timings = {}
+    peaks = {}
+    for headers, transmitter in messages:
+        for name, stage in stages(headers, transmitter):
+            stage()  # warm up
+            t = timings.setdefault(name, [])
+            for i in range(0, repeat):
+                start = time.perf_counter()
+                stage()
+                t.append(time.perf_counter() - start)
+
+            tracemalloc.start()
+            try:
+                stage()
+                peaks.setdefault(name, []).append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+
+    results = {}
+    for name, t in timings.items():
+        t.sort()
+        results[name] = {
+            "n": len(t),
+            "p50_ms": percentile(t, 50) * 1000,
+            "p99_ms": percentile(t, 99) * 1000,
+            "mean_ms": sum(t) / len(t) * 1000,
+            "peak_kb": max(peaks[name]) / 1024.0
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :param results: as from run
+    :param baseline: a saved result of run
+    :param threshold: the fraction by which p50 or p99 may grow before it counts as a regression
+    :return: a list of lines describing the regressions, empty if there were none
+    """
+    regressions = []
+    for name, stats in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for k in ("p50_ms", "p99_ms"):
+            if stats[k] > baseline[name][k] * (1 + threshold):
+                regressions.append("%s %s %.3f -> %.3f" % (name, k, baseline[name][k], stats[k]))
+    return regressions
+
+
+def report(results, baseline=None):
+    lines = ["%-16s %8s %9s %9s %9s %9s" % ("stage", "n", "p50 ms", "p99 ms", "mean ms", "peak KB")]
+    for name, stats in sorted(results.items()):
+        lines.append("%-16s %8d %9.3f %9.3f %9.3f %9.1f" % (
+            name, stats["n"], stats["p50_ms"], stats["p99_ms"], stats["mean_ms"], stats["peak_kb"]))
+        if baseline and name in baseline:
+            b = baseline[name]
+            change = [(stats[k] / b[k] - 1) * 100 if b[k] else 0
+                      for k in ("p50_ms", "p99_ms", "mean_ms", "peak_kb")]
+            lines.append("%-16s %8s %+8.1f%% %+8.1f%% %+8.1f%% %+8.1f%%" % tuple(["  vs. baseline", ""] + change))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    clparser = argparse.ArgumentParser(description="Benchmark the SAME decoder")
+    clparser.add_argument("--messages", default=_DIRTY_MESSAGES, help="a file like tests/dirty_messages.json")
+    clparser.add_argument("--repeat", default=20, type=int)
+    clparser.add_argument("--save", default=None, help="write the results to this JSON file")
+    clparser.add_argument("--compare", default=None, help="compare against results saved from an earlier run")
+    clparser.add_argument("--threshold", default=0.1, type=float, help="allowed slowdown vs. the baseline")
+    args = clparser.parse_args(args)
+
+    # Decoded messages get logged at warning levels and above, which would swamp the report
+    logging.disable(logging.CRITICAL + 10)
+
+    results = run(load_messages(args.messages), args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding='UTF-8') as f:
+            baseline = json.load(f)
+    print(report(results, baseline))
+
+    if args.save:
+        with open(args.save, "w", encoding='UTF-8') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,7 +27,7 @@ setup(
     # dependency_links=[
     #   'git+https://github.com/nioinnovation/Adafruit_Python_GPIO.git'
     # ],
-    setup_requires=['pytest-runner', 'urllib3', 'shapely', 'iso8601'],
+    setup_requires=['pytest-runner', 'urllib3', 'shapely', 'iso8601', 'numpy'],
     tests_require=['pytest'],
     test_suite="tests",
 )
@@ -20,11 +20,18 @@ import random
 import unittest
 from RPiNWR.SAME import *
 import RPiNWR.SAME as SAME
+from RPiNWR.expiry import *
+from RPiNWR.snapshot import *
 import logging
 import json
 from calendar import timegm
 import os
 import string
+import collections
+import functools
+import time
+import tempfile
+import threading
 
 
 class TestSAME(unittest.TestCase):
@@ -158,6 +165,42 @@ class TestSAME(unittest.TestCase):
         self.assertEqual("037151", w[7:])
         self.assertEqual(list([int(x) for x in "998997"]), c[7:])
 
+    def test_candidate_index(self):
+        counties = '037037-037063-037069-037077-037085-037101-037151-037151'.split('-')
+        index = SAME._CandidateIndex(counties)
+        self.assertEqual(8, len(index))
+        self.assertEqual("037151", index.nearest("030151", [9, 9, 2, 9, 9, 7])[0][1])
+        self.assertEqual("037151", index.nearest("037151", [9] * 6, collections.Counter(["037151"]))[0][1])
+        self.assertNotEqual("037151", index.nearest("037151", [9] * 6, collections.Counter(["037151"] * 2))[0][1])
+
+        # An index can be reused from one decode to the next
+        index = SAME._CandidateIndex(counties[:-1])
+        w, c, d = SAME._reconcile_word("030151", "992997", 0, index)
+        self.assertEqual("037151", w)
+        w, c, d = SAME._reconcile_word("030151", "992997", 0, index)
+        self.assertEqual("037151", w)
+
+    def test_vote_bits(self):
+        # 'W' = 0101 0111, 'R' = 0101 0010; a null casts no vote
+        bitstrue, bitsfalse = SAME._vote_bits([('W', '2', 0), ('R', [1], 0), ('\x00', '3', 0)])
+        self.assertEqual((1, 8), bitstrue.shape)
+        self.assertEqual([2, 3, 2, 0, 3, 0, 3, 0], bitstrue[0].tolist())
+        self.assertEqual([1, 0, 1, 3, 0, 3, 0, 3], bitsfalse[0].tolist())
+
+        # Shorter headers don't vote past their end
+        bitstrue, bitsfalse = SAME._vote_bits([('-W', '33', 0), ('-', '3', 0)])
+        self.assertEqual(3 * 8, int(bitstrue[1].sum() + bitsfalse[1].sum()))
+
+    def test_average_with_old_numpy(self):
+        # numpy before 1.17 (as packaged for Raspbian Buster) has no bitorder for packbits
+        clear_message, messages = self.make_noisy_messages(.03)
+        packbits = SAME.numpy.packbits
+        SAME.numpy.packbits = lambda a, axis=None: packbits(a, axis=axis)
+        try:
+            self.assertEqual(clear_message, average_message(messages, "KID77")[0])
+        finally:
+            SAME.numpy.packbits = packbits
+
     def test_dirty_messages(self):
         logging.basicConfig(level=logging.INFO)
         messages = self.load_dirty_messages()
@@ -329,6 +372,86 @@ class TestSAME(unittest.TestCase):
                 errstr += "_"
         return errstr
 
+    def test_exact_match(self):
+        msg = "-WXR-SVR-037183+0045-1232003-KRAH/NWS-"
+        clean = (msg + "\x00\x7f", "3" * len(msg) + "00", 1462328285)
+        noisy = ("-WXR-SVR-037183+0045-1232003-KRAH/NWS\x00", "3" * len(msg), 1462328285)
+        exact = SAME.DECODE_COUNTS["exact"]
+        self.assertEqual((msg, [9] * len(msg)), average_message([clean, noisy, clean], "WXL58"))
+        self.assertEqual(exact + 1, SAME.DECODE_COUNTS["exact"])
+
+        # One clean header isn't enough
+        reconciled = SAME.DECODE_COUNTS["reconciled"]
+        self.assertEqual(msg, average_message([clean, noisy, noisy], "WXL58")[0])
+        self.assertEqual(exact + 1, SAME.DECODE_COUNTS["exact"])
+        self.assertEqual(reconciled + 1, SAME.DECODE_COUNTS["reconciled"])
+
+        # A message read header by header counts once, when it's complete
+        m = SAMEMessage("WXL58")
+        for i in range(0, 3):
+            m.add_header(msg, "3" * len(msg))
+            self.assertEqual(msg, m.get_SAME_message()[0])
+        m.get_SAME_message()
+        self.assertEqual(exact + 2, SAME.DECODE_COUNTS["exact"])
+        self.assertEqual(reconciled + 1, SAME.DECODE_COUNTS["reconciled"])
+
+    def test_provisional_decode(self):
+        clear_message, messages = self.make_noisy_messages(.03)
+        m = SAMEMessage("KID77")
+        self.assertEqual(("", []), m.get_SAME_message())
+        for i in range(0, 3):
+            m.add_header(messages[i][0], messages[i][1])
+            self.assertEqual(average_message(m.headers, "KID77"), m.get_SAME_message())
+            self.assertEqual(i == 2, m.fully_received())
+        self.assertEqual(clear_message, m.get_SAME_message()[0])
+        self.assertEqual("RWT", m.get_event_type())
+
+    def test_decode_while_adding_header(self):
+        # A listener on another thread can ask for the message while its third header is being added
+        clear_message, messages = self.make_noisy_messages(.03)
+        m = SAMEMessage("KID77")
+        for i in range(0, 2):
+            m.add_header(messages[i][0], messages[i][1])
+        tallying = threading.Event()
+        tallied = threading.Event()
+        vote_bits = SAME._vote_bits
+
+        def slow_vote_bits(headers):
+            tallying.set()
+            tallied.wait(5)
+            return vote_bits(headers)
+
+        decodes = []
+        SAME._vote_bits = slow_vote_bits
+        try:
+            adding = threading.Thread(target=m.add_header, args=messages[2][0:2])
+            adding.start()
+            tallying.wait(5)
+            reading = threading.Thread(target=lambda: decodes.append(m.get_SAME_message()))
+            reading.start()
+            reading.join(.1)
+            tallied.set()
+            adding.join(5)
+            reading.join(5)
+        finally:
+            SAME._vote_bits = vote_bits
+        self.assertEqual([average_message(m.headers, "KID77")], decodes)
+
+    def test_add_header_bytes(self):
+        clear_message, messages = self.make_noisy_messages(.03)
+        m = SAMEMessage("KID77")
+        b = SAMEMessage("KID77")
+        for i in range(0, 3):
+            m.add_header(messages[i][0], messages[i][1])
+            b.add_header(bytearray([ord(c) & 0xFF for c in messages[i][0]]),
+                         bytearray([int(c) for c in messages[i][1]]))
+        self.assertEqual([h[0:2] for h in m.headers], [h[0:2] for h in b.headers])
+        self.assertEqual(m.get_SAME_message(), b.get_SAME_message())
+
+    def test_reconstituted_headers_match_average(self):
+        clear_message, messages = self.make_noisy_messages(.05)
+        self.assertEqual(average_message(messages, "KID77"), SAMEMessage("KID77", messages).get_SAME_message())
+
     def test_county_parse(self):
         c = SAMEMessage(
             '-WXR-RWT-020103-020209-020091-020121-029047-029165-029095-029037+0030-3031700-KEAX/NWS-').get_counties()
@@ -394,6 +517,26 @@ class TestSAME(unittest.TestCase):
         self.assertEqual(60 * 60, m.get_duration_sec())
         self.assertEqual(1462328280 + 60 * 60, m.get_end_time_sec())
 
+    def test_fields(self):
+        m = SAMEMessage(transmitter=None, headers=[("-WXR-SVR-037085-137101+0100-1250218-KRAH/NWS-", '9' * 46, 1462328285)])
+        f = m.get_fields()
+        self.assertIs(f, m.get_fields())  # parsed only once
+        self.assertEqual(SAMEFields("WXR", "SVR", ("037085", "137101"), "0100", 60 * 60, "1250218", 1462328280,
+                                    "KRAH/NWS"), f)
+
+    def test_decode_profile(self):
+        profile = get_decode_profile("WXL58")
+        self.assertIs(profile, get_decode_profile("WXL58"))
+        self.assertIs(profile, get_decode_profile(profile))
+        self.assertEqual(1, profile.counties["037183"])
+        self.assertEqual(0, len(get_decode_profile("no such transmitter").fips_index))
+
+        headers = [("-WXR-SVR-037183+0045-1232003-KRAH/NWS-", "9" * 38, 1462328285)]
+        m = SAMEMessage(profile, headers)
+        self.assertEqual("WXL58", m.transmitter)
+        self.assertEqual(SAMEMessage("WXL58", headers), m)
+        self.assertEqual(average_message(headers, "WXL58"), average_message(headers, profile))
+
     def test_get_broadcaster(self):
         self.assertEqual("KRAH/NWS", SAMEMessage("-WXR-SVR-037085-037101+0100-1250218-KRAH/NWS-").get_broadcaster())
 
@@ -424,6 +567,10 @@ class TestSAME(unittest.TestCase):
         self.assertEqual((2, 'L'), SAME._reconcile_character(bitstrue, bitsfalse,
                                                              'ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
 
+        # A = 0100 0001 and B = 0100 0010 are equally far from 0100 0011, so it's a tie, less confidence
+        self.assertEqual((1, 'A'), SAME._reconcile_character([1, 1, 0, 0, 0, 0, 1, 0], [0, 0, 1, 1, 1, 1, 0, 1], 'BA'))
+        self.assertEqual((2, 'B'), SAME._reconcile_character([1, 2, 0, 0, 0, 0, 1, 0], [0, 0, 1, 1, 1, 1, 0, 1], 'BA'))
+
     def test_split_message(self):
 
         '''
@@ -475,6 +622,15 @@ class TestSAME(unittest.TestCase):
         # assert
         self.assertEqual(test_mutate_string, expected_result)
 
+    def test_frame_detector(self):
+        msg = "-WXR-SVR-037085-037101+0100-1250218-KRAH/NWS-"
+        detector = FrameDetector()
+        for i in range(0, len(msg) + 16, 8):  # 8 bytes at a time, with trailing junk
+            detector.feed((msg + "\x00" * 16)[i:i + 8], [3] * 8)
+        self.assertEqual((0, len(msg)), detector.best())
+        self.assertEqual(38, detector.best(len(msg) - 1)[1])
+        self.assertIsNone(FrameDetector().best())
+
     def test__truncate(self):
 
         # NOTES:
@@ -541,3 +697,159 @@ class TestSAME(unittest.TestCase):
         self.assertEqual(''.join(test_truncate_short[0]), expected_message_short)
 
 
+
+
+_STORM = [
+    "-WXR-SVR-037183+0045-1232003-KRAH/NWS-",
+    "-WXR-SVR-037151+0030-1232003-KRAH/NWS-",
+    "-WXR-SVR-037037+0045-1232023-KRAH/NWS-",
+    "-WXR-SVR-037001-037151+0100-1232028-KRAH/NWS-",
+    "-WXR-SVR-037069-037077-037183+0045-1232045-KRAH/NWS-",
+    "-WXR-SVR-037001+0045-1232110-KRAH/NWS-",
+    "-WXR-SVR-037069-037181-037185+0045-1232116-KRAH/NWS-",
+    "-WXR-FFW-037125+0300-1232209-KRAH/NWS-",
+    "-WXR-SVA-037001-037037-037063-037069-037077-037085-037101-037105-037125-037135-037145-037151-037181-037183-037185+0600-1241854-KRAH/NWS-",
+    "-WXR-SVR-037001-037037-037151+0045-1242011-KRAH/NWS-",
+    "-WXR-TOR-037183+0015-1242204-KRAH/NWS-",
+    "-WXR-SVR-037101-037183+0100-1242235-KRAH/NWS-",
+]
+
+
+class TestSAMECache(unittest.TestCase):
+    def setUp(self):
+        self.alerts = [SAMEMessage("WXL58", x) for x in _STORM]
+        self.cache = SAMECache("037183")
+        for a in self.alerts:
+            self.cache.add_message(a)
+
+    def brute_force(self, start, end, here=True):
+        l = list([a for a in self.alerts if a.get_start_time_sec() <= end and a.get_end_time_sec() >= start and
+                  a.applies_to_fips("037183") == here])
+        l.sort(key=functools.cmp_to_key(default_SAME_sort))
+        return l
+
+    def test_active_messages(self):
+        t0 = int(self.alerts[0].get_start_time_sec())
+        for t in range(t0 - 600, int(self.alerts[-1].get_end_time_sec()) + 600, 300):
+            for here in (True, False):
+                self.assertEqual(self.brute_force(t, t, here), self.cache.get_active_messages(t, here=here))
+        self.assertEqual(["SVR"], [m.get_event_type() for m in self.cache.get_active_messages(t0, "SV.")])
+
+    def test_messages_active_between(self):
+        t0 = self.alerts[0].get_start_time_sec()
+        for start, end in ((t0, t0 + 3600), (t0 + 3600, t0 + 86400), (t0 - 60, t0 - 1)):
+            self.assertEqual(self.brute_force(start, end), self.cache.get_messages_active_between(start, end))
+            self.assertEqual(self.brute_force(start, end, False),
+                             self.cache.get_messages_active_between(start, end, here=False))
+
+    def test_clear_inactive(self):
+        t = self.alerts[-1].get_start_time_sec()
+        active = self.cache.get_active_messages(t)
+        self.cache.clear_inactive(t)
+        self.assertEqual(active, self.cache.get_active_messages(t))
+        for here in (True, False):
+            self.assertTrue(all([m.is_effective(t) for m in self.cache.get_messages_active_between(0, t, here=here)]))
+        self.assertEqual(active, self.cache.get_messages_active_between(0, t))
+
+    def test_top_message(self):
+        t0 = int(self.alerts[0].get_start_time_sec())
+        for t in range(t0 - 600, int(self.alerts[-1].get_end_time_sec()) + 600, 300):
+            for here in (True, False):
+                active = self.cache.get_active_messages(t, here=here)
+                self.assertIs(active[0] if len(active) else None, self.cache.get_top_message(t, here))
+
+    def test_sort_key(self):
+        for a in self.alerts:
+            for b in self.alerts:
+                self.assertEqual(default_SAME_sort(a, b) < 0, default_SAME_sort_key(a) < default_SAME_sort_key(b))
+
+        # Any other comparator still works
+        oldest_first = SAMECache("037183", lambda a, b: a.get_start_time_sec() - b.get_start_time_sec())
+        for a in self.alerts:
+            oldest_first.add_message(a)
+        t = self.alerts[-1].get_start_time_sec()
+        self.assertEqual("SVA", oldest_first.get_top_message(t).get_event_type())
+        self.assertEqual("TOR", self.cache.get_top_message(self.alerts[-2].get_start_time_sec()).get_event_type())
+
+    def test_expiry_sweeper(self):
+        expired = []
+        sweeper = ExpirySweeper(expired.append)
+        try:
+            cache = SAMECache("037183", sweeper=sweeper)
+            for a in self.alerts:
+                cache.add_message(a)
+            # and one that won't expire for a while
+            current = SAMEMessage("WXL58", time.strftime("-WXR-SVR-037183+0600-%j%H%M-KRAH/NWS-", time.gmtime()))
+            cache.add_message(current)
+
+            timeout = time.time() + 5
+            while len(expired) < len(self.alerts) and time.time() < timeout:
+                time.sleep(.01)
+            self.assertEqual(len(self.alerts), len(expired))
+            self.assertTrue(all([type(e) is AlertExpired for e in expired]))
+            self.assertEqual(set([id(a) for a in self.alerts]), set([id(e.message) for e in expired]))
+            self.assertEqual([current], cache.get_messages_active_between(0, time.time() + 3600))
+            self.assertIs(current, cache.get_top_message())
+            self.assertEqual([current], cache.get_active_messages(fips="037183"))
+            self.assertEqual(1, len(sweeper))
+        finally:
+            sweeper.close()
+
+    def test_snapshot(self):
+        headers = [("-WXR-TOR-037183+0030-1242210-KRAH/NWS-", "9" * 38, self.alerts[-2].get_start_time_sec())] * 3
+        decoded = SAMEMessage("WXL58", headers)
+        self.cache.add_message(decoded)
+        everything = self.alerts + [decoded]
+        t = self.alerts[-1].get_start_time_sec()
+        with tempfile.TemporaryDirectory() as d:
+            write_snapshot(os.path.join(d, "same.snapshot"), self.cache.snapshot(t))
+            snapshot = read_snapshot(os.path.join(d, "same.snapshot"))
+        restored = SAMECache("037183")
+        self.assertEqual(len([a for a in everything if a.get_end_time_sec() >= t]), restored.restore(snapshot, t))
+        for tt in range(int(t), int(t) + 86400, 900):
+            for here in (True, False):
+                self.assertEqual(self.cache.get_active_messages(tt, here=here),
+                                 restored.get_active_messages(tt, here=here))
+        self.assertEqual(decoded.get_SAME_message(), restored.get_active_messages(t, "TOR")[0].get_SAME_message())
+        self.assertEqual(decoded.headers, restored.get_active_messages(t, "TOR")[0].headers)
+        self.assertRaises(ValueError, restored.restore, {"kind": "MessageCache"})
+
+    def test_stats(self):
+        t = self.alerts[-1].get_start_time_sec()
+        active = self.cache.get_active_messages(t)
+        self.cache.clear_inactive(t)
+        stats = self.cache.stats()
+        self.assertEqual(len(self.alerts), stats["added"])
+        self.assertEqual(len([a for a in self.alerts if not a.is_effective(t)]), stats["evicted"])
+        self.assertEqual(1, stats["queries"])
+        self.assertEqual(len(active), stats["query_results"]["sum"])
+        self.assertEqual(len(self.alerts) + 1, stats["lock_wait_seconds"]["count"])
+        self.cache.snapshot(t)
+        self.assertEqual(len(self.alerts) + 2, self.cache.stats()["lock_wait_seconds"]["count"])
+
+    def test_fips(self):
+        subdivided = [SAMEMessage("WXL58", x) for x in [
+            "-WXR-SVR-137183-037151+0100-1232003-KRAH/NWS-",
+            "-WXR-SVR-237183-937183+0100-1232003-KRAH/NWS-",
+            "-WXR-TOR-237183-037183+0100-1232003-KRAH/NWS-"]]
+        for a in subdivided:
+            self.cache.add_message(a)
+        everything = self.alerts + subdivided
+
+        def brute_force(fips, start, end):
+            l = list([a for a in everything if a.get_start_time_sec() <= end and a.get_end_time_sec() >= start and
+                      a.applies_to_fips(fips)])
+            l.sort(key=functools.cmp_to_key(default_SAME_sort))
+            return l
+
+        t0 = int(self.alerts[0].get_start_time_sec())
+        for fips in ("037183", "37183", "137183", "237183", "337183", "937183", "037151", "137151", "037999"):
+            for t in range(t0 - 600, int(self.alerts[-1].get_end_time_sec()) + 600, 900):
+                self.assertEqual(brute_force(fips, t, t), self.cache.get_active_messages(t, fips=fips), fips)
+            self.assertEqual(brute_force(fips, t0, t0 + 86400),
+                             self.cache.get_messages_active_between(t0, t0 + 86400, fips=fips))
+        self.assertRaises(ValueError, self.cache.get_active_messages, t0, fips="0371830")
+
+        t = self.alerts[-1].get_start_time_sec()
+        self.cache.clear_inactive(t)
+        self.assertEqual(brute_force("037183", t, t), self.cache.get_active_messages(t, fips="037183"))
@@ -18,6 +18,9 @@ __author__ = 'ke4roh'
 
 from RPiNWR.Si4707 import *
 from RPiNWR.Si4707.mock import MockContext
+from RPiNWR.Si4707.aio import AsyncSi4707
+import asyncio
+import concurrent.futures
 import unittest
 import logging
 
@@ -61,6 +64,37 @@ class TestSi4707(unittest.TestCase):
                 future = radio.do_command(ExceptionalCommand())
                 self.assertRaises(Exception, future.get)
 
+    def test_batch(self):
+        events = []
+        ran = []
+        with MockContext() as context:
+            with Si4707(context) as radio:
+                radio.register_event_listener(events.append)
+                radio.power_on({"frequency": 162.4})
+                batch = radio.do_commands([GetProperty("RX_VOLUME"), Callback(lambda: ran.append(1) or 5)])
+                self.assertEqual([63, 5], batch.get())
+
+                # A failure stops the batch
+                batch = radio.do_commands([Callback(lambda: 1 / 0), Callback(ran.append, [2])])
+                self.assertRaises(FutureException, batch.get)
+                self.assertIsInstance(batch.exception(), ZeroDivisionError)
+
+                # Futures can be waited on together
+                futures = [radio.do_command(Callback(ran.append, [i])) for i in range(3, 6)]
+                done, not_done = concurrent.futures.wait(futures, timeout=1)
+                self.assertEqual(3, len(done))
+
+                # Waiting too long raises the builtin TimeoutError, as it always has
+                running = threading.Event()
+                slow = radio.do_command(Callback(lambda: running.set() or time.sleep(.2)))
+                running.wait(1)
+                self.assertRaises(TimeoutError, slow.get, .01)
+                self.assertIsNone(slow.get())
+        self.assertEqual([1, 3, 4, 5], ran)
+        # The commands in a batch each make their event, as if run one by one
+        self.assertEqual(1, len([e for e in events if type(e) is PatchCommand]))
+        self.assertTrue(len([e for e in events if type(e) is SetProperty]) > 1)
+
     def test_set_property(self):
         events = []
 
@@ -142,6 +176,130 @@ class TestSi4707(unittest.TestCase):
         self.assertEqual(1, len(rsqe))
         self.assertEqual(1, rsqe[0].frequency_offset)
 
+    def test_idle_without_polling(self):
+        with MockContext() as context:
+            with Si4707(context) as radio:
+                radio.interrupt_check_sec = 60  # so that nothing here is done by the check in case an edge was missed
+                radio.power_on({"frequency": 162.4})
+                time.sleep(.2)  # for the interrupts from tuning to settle
+                writes = []
+                write8 = context.write8
+                context.write8 = lambda reg, value: writes.append(reg) or write8(reg, value)
+                time.sleep(1.5)
+                self.assertTrue(writes.count(0x14) <= 1, writes)  # GET_INT_STATUS
+
+                # But a command doesn't wait for a check of the interrupts, and neither does an interrupt
+                del writes[:]
+                self.assertEqual(63, radio.do_command(GetProperty("RX_VOLUME")).get(timeout=5))
+                self.assertNotIn(0x14, writes)
+                context.bus.pop(0x53, None)
+                context.interrupts |= 8  # RSQ
+                timeout = time.time() + 5
+                while 0x53 not in context.bus or context.bus[0x53] != [1]:  # WB_RSQ_STATUS with INTACK
+                    time.sleep(.005)
+                    self.assertTrue(time.time() < timeout)
+
+    def test_late_cts_interrupt(self):
+        class LateContext(MockContext):
+            # Signal interrupts from another thread, some time after they happen, as from a GPIO callback
+            def interrupt(self):
+                threading.Timer(.005, super(LateContext, self).interrupt).start()
+
+        with LateContext() as context:
+            with Si4707(context) as radio:
+                radio.power_on({"frequency": 162.4})
+                time.sleep(.2)  # for the interrupts from tuning to settle
+                writes = []
+                write8 = context.write8
+                context.write8 = lambda reg, value: writes.append(reg) or write8(reg, value)
+                time.sleep(1.5)
+                self.assertTrue(writes.count(0x14) <= 3, writes)  # GET_INT_STATUS, not set off by its own CTS
+                self.assertTrue(radio.get_volume() >= 0)
+
+    def test_clear_to_send(self):
+        with MockContext() as context:
+            with Si4707(context) as radio:
+                radio.power_on({"frequency": 162.4})
+                self.assertTrue(radio.cts_interrupt)
+                radio.get_volume()
+        stats = radio.cts_metrics.stats()
+        for key in ["POWER_UP", "PATCH", "WB_TUNE_STATUS", "GET_PROPERTY", "GET_INT_STATUS"]:
+            self.assertTrue(stats["cts_seconds_" + key]["count"] > 0, key)
+        self.assertFalse(radio.cts_interrupt)  # after power down
+
+        # Without interrupts, the status is read less often for commands known to take a while
+        class SlowRadio(object):
+            def __init__(self, sec):
+                self.cts = time.time() + sec
+                self.reads = 0
+
+            def _read_status(self):
+                self.reads += 1
+                return Status([128 if time.time() >= self.cts else 0])
+
+        polling = CTSPolling()
+        first = SlowRadio(.05)
+        self.assertTrue(polling.wait(first, "SLOW", None).is_clear_to_send())
+        for i in range(20):
+            polling.wait(SlowRadio(.05), "SLOW", None)
+        self.assertTrue(.03 < polling.typical_sec("SLOW") < .08, polling.typical_sec("SLOW"))
+        learned = SlowRadio(.05)
+        polling.wait(learned, "SLOW", None)
+        self.assertTrue(learned.reads < first.reads, (learned.reads, first.reads))
+        self.assertIsNone(polling.wait(SlowRadio(1), "SLOW", time.time() + .01))
+
+    def test_async(self):
+        async def operate(radio):
+            events = []
+            powered_off = asyncio.Event()
+
+            async def listen():
+                async for event in radio.events():
+                    events.append(event)
+                    if type(event) is RadioPowerEvent and not event.power_on:
+                        powered_off.set()
+
+            listening = asyncio.ensure_future(listen())
+            await asyncio.sleep(0)  # to start listening
+            threads = threading.active_count()
+            rssi, snr, frequency = await radio.tune("WXL58")
+            self.assertEqual(162.55, frequency)
+            await asyncio.gather(radio.set_volume(99), radio.mute(True))
+            volume, mute = await asyncio.gather(radio.get_volume(), radio.get_mute())
+            self.assertTrue(0 <= volume <= 63)
+            self.assertEqual(threads, threading.active_count())
+            with self.assertRaises(FutureException):
+                await radio.queue_callback(lambda: 1 / 0)
+            await radio.power_off()
+            await asyncio.wait_for(powered_off.wait(), 1)
+            listening.cancel()
+            return events
+
+        with MockContext() as context:
+            with Si4707(context) as radio:
+                radio.power_on({"frequency": 162.4})
+                events = asyncio.run(operate(AsyncSi4707(radio)))
+        self.assertTrue(any(type(e) is TuneFrequency for e in events), [str(e) for e in events])
+        self.assertEqual("WXL58", radio.transmitter)
+
+    def test_register_while_unregistering(self):
+        radio = Si4707(MockContext())
+        registering = []
+
+        class Listeners(list):
+            # Register another listener from another thread just as the unregistration has gone through the list
+            def __iter__(self):
+                yield from list.__iter__(self)
+                t = threading.Thread(target=radio.register_event_listener, args=[print])
+                t.start()
+                t.join(.1)  # until it's registered, or waiting for the unregistration to finish
+                registering.append(t)
+
+        radio._Si4707__event_listeners = Listeners([len])
+        radio.unregister_event_listener(len)
+        registering[0].join(1)
+        self.assertEqual([print], radio._Si4707__event_listeners)
+
     def test_alert_tone_detection(self):  # WB_ASQ_STATUS
         events = []
         tone_duration = 0.5
@@ -204,6 +362,10 @@ class TestSi4707(unittest.TestCase):
                 same_messages = list(filter(lambda x: type(x) is SAMEMessageReceivedEvent, events))
                 self.assertEquals(1, len(same_messages))
                 self.assertEquals(message, same_messages[0].message.get_SAME_message()[0])
+                self.assertEquals("KID77", radio.decode_profile.transmitter)
+                self.assertEquals("KID77", same_messages[0].message.transmitter)
+                for header in filter(lambda x: type(x) is SAMEHeaderReceived, events):
+                    self.assertEquals((0, len(message)), header.frame)
                 for interrupt in ["EOMDET", "HDRRDY", "PREDET"]:
                     times = len(self.__filter_same_events(events, interrupt))
                     self.assertEquals(3, times, "Interrupt %s happened %d times" % (interrupt, times))
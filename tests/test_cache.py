@@ -19,8 +19,16 @@ import unittest
 from RPiNWR.SAME import *
 from RPiNWR.cache import *
 from RPiNWR.VTEC import *
+from RPiNWR.expiry import *
+from RPiNWR.snapshot import *
+from RPiNWR.metrics import *
+import time
 import pickle
+from shapely.geometry import Point
 import os
+import tempfile
+import gzip
+import json
 
 class TestCache(unittest.TestCase):
     def test_buffer_for_radio_against_storm_system(self):
@@ -527,3 +535,222 @@ class TestCache(unittest.TestCase):
         buf.add_message(valerts[0])
         self.assertTrue(buf.is_effective((40.321909, -102.718192), "008125", True, valerts[0].published))
         self.assertFalse(buf.is_effective((40.321909, -102.718192), "008125", False, valerts[0].published))
+
+    def test_clear_inactive(self):
+        alerts = [SAMEMessage("WXL58", x) for x in [
+            "-WXR-SVR-037183+0045-1232003-KRAH/NWS-",
+            "-WXR-SVR-037151+0030-1232003-KRAH/NWS-",
+            "-WXR-TOR-037183+0015-1242204-KRAH/NWS-"]]
+        buf = MessageCache((35.73, -78.85), "037183", default_SAME_sort)
+        for a in alerts[0:2]:
+            buf.add_message(a)
+        t = alerts[0].get_start_time_sec() + 60
+        buf.clear_inactive(t)
+        self.assertEqual(1, len(buf.get_active_messages(when=t)))
+        self.assertEqual(1, len(buf.get_active_messages(when=t, here=False)))
+
+        buf.clear_inactive(alerts[2].get_start_time_sec())
+        buf.add_message(alerts[2])
+        self.assertEqual(["TOR"], [x.get_event_type() for x in
+                                   buf.get_active_messages(when=alerts[2].get_start_time_sec())])
+
+    def test_expiry_sweeper(self):
+        expired = []
+        sweeper = ExpirySweeper(expired.append)
+        try:
+            buf = MessageCache((35.73, -78.85), "037183", default_SAME_sort, sweeper)
+            old = SAMEMessage("WXL58", "-WXR-SVR-037183+0045-1232003-KRAH/NWS-")
+            current = SAMEMessage("WXL58", time.strftime("-WXR-SVR-037183+0600-%j%H%M-KRAH/NWS-", time.gmtime()))
+            buf.add_message(old)
+            buf.add_message(current)
+            timeout = time.time() + 5
+            while not len(expired) and time.time() < timeout:
+                time.sleep(.01)
+            self.assertEqual([old.event_id], [e.message.get_event_id() for e in expired])
+            self.assertEqual(1, len(buf.get_active_messages()))
+        finally:
+            sweeper.close()
+
+    def test_fips_index(self):
+        index = FIPSIndex()
+        index.add("a", ["037183", "037151"])
+        index.add("b", ["137183"])
+        index.add("c", ["237183", "037001"])
+        index.add("a", ["037001"])
+        self.assertEqual(["a", "b", "c"], index.lookup("037183"))
+        self.assertEqual(["a", "b"], index.lookup("137183"))
+        self.assertEqual(["a", "c"], index.lookup("037001"))
+        self.assertEqual([], index.lookup("037999"))
+        index.remove("a")
+        self.assertEqual(["b", "c"], index.lookup("037183"))
+        self.assertEqual(["b"], index.lookup("137183"))
+        self.assertEqual(2, len(index))
+        self.assertEqual(["b", "c"], index.lookup("37183"))  # without the P component
+        self.assertRaises(ValueError, index.lookup, "7183")
+
+        # As applies_to_fips would have it
+        same = SAMEMessage("WXL58", "-WXR-SVR-037183+0045-1232003-KRAH/NWS-")
+        self.assertTrue(same.applies_to_fips("37183"))
+        buf = MessageCache(None, "37183", default_SAME_sort)
+        buf.add_message(same)
+        self.assertEqual(1, len(buf.get_active_messages(same.get_start_time_sec())))
+
+    def test_events_at(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "kgld.cap.p"), "rb") as f:
+            alerts = pickle.load(f)
+        buf = MessageCache((40.321909, -102.718192), "008125", default_VTEC_sort)
+        for t, cap in alerts:
+            for v in cap.vtec:
+                buf.add_message(v)
+
+        points = [(40.321909, -102.718192), (0, 0)] + list(
+            [c.polygon.centroid.coords[0] for t, c in alerts if c.polygon is not None][::3])
+        for t in range(alerts[0][0], alerts[-1][0] + 2, 600):
+            everywhere = buf.get_active_messages(t) + buf.get_active_messages(t, here=False)
+            expected = []
+            for p in points:
+                expected.append(set([g.get_event_id() for g in everywhere if g.get_polygon_message(t) is not None and
+                                     g.get_polygon_message(t).polygon.contains(Point(*p))]))
+            self.assertEqual(expected, [set([g.get_event_id() for g in l]) for l in buf.get_events_at(points, t)])
+
+        cap = [c for t, c in alerts if c.polygon is not None][0]
+        self.assertEqual(cap.polygon.contains(Point(*points[0])), cap.polygon_contains(points[0]))
+        self.assertEqual(cap, pickle.loads(pickle.dumps(cap)))  # still picklable once prepared
+
+    def test_subscribers(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "kgld.cap.p"), "rb") as f:
+            alerts = pickle.load(f)
+        counties = sorted(set([fips for t, c in alerts for v in c.vtec for fips in v.get_areas()]))
+        points = [(40.321909, -102.718192), None] + list(
+            [c.polygon.centroid.coords[0] for t, c in alerts if c.polygon is not None][::3])
+        subscribers = {}
+        for fips in counties[::2]:
+            for p in points:
+                subscribers[(fips, p)] = (p, fips)
+
+        changes = []
+        buf = SubscriberCache(default_VTEC_sort, lambda x: changes.append(x))
+        for sid, (p, fips) in subscribers.items():
+            buf.add_subscriber(sid, p, fips, alerts[0][0])
+        groups = {}
+        held = dict([(sid, set()) for sid in subscribers])
+
+        def check(t):
+            for x in changes:
+                held[x.subscriber_id].update([g.get_event_id() for g in x.gained])
+                held[x.subscriber_id].difference_update([g.get_event_id() for g in x.lost])
+            del changes[:]
+            for sid, (p, fips) in subscribers.items():
+                expected = set([k for k, g in groups.items() if g.is_effective(p, fips, True, t)])
+                self.assertEqual(expected, held[sid], sid)
+                self.assertEqual(expected, set([g.get_event_id() for g in buf.get_active_messages(sid)]), sid)
+
+        for t, cap in alerts:
+            for v in cap.vtec:
+                groups.setdefault(v.event_id, EventMessageGroup()).add_message(v)
+                buf.add_message(v, t)
+            buf.clear_inactive(t)  # no sweeper, so expirations only show up here
+            check(t)
+        self.assertTrue(len([sid for sid in held if len(held[sid])]) > 0)
+        for t in range(alerts[-1][0], alerts[-1][0] + 86400, 3600):
+            buf.clear_inactive(t)
+            check(t)
+        self.assertEqual(0, sum([len(x) for x in held.values()]))
+
+    def test_add_subscribers(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "kgld.cap.p"), "rb") as f:
+            alerts = pickle.load(f)
+        one, bulk = [SubscriberCache(default_VTEC_sort, lambda x: None) for i in range(2)]
+        for t, cap in alerts:
+            for v in cap.vtec:
+                one.add_message(v, t)
+                bulk.add_message(v, t)
+            if cap.polygon is not None and len(cap.vtec) and cap.vtec[0].action == "NEW":
+                break  # with a polygon in effect
+        minx, miny, maxx, maxy = cap.polygon.bounds
+        fips = cap.vtec[0].get_areas()[0]
+        subscribers = list([(i, (minx + (maxx - minx) * (i % 17) / 16, miny + (maxy - miny) * (i // 17) / 16), fips)
+                            for i in range(17 * 17)]) + [("nowhere", None, fips)]
+        for s in subscribers:
+            one.add_subscriber(*s, when=t)
+        bulk.add_subscribers(subscribers, t)
+        found = list([[g.get_event_id() for g in one.get_active_messages(s[0])] for s in subscribers])
+        self.assertEqual(found, list([[g.get_event_id() for g in bulk.get_active_messages(s[0])] for s in subscribers]))
+        self.assertTrue(0 < len([x for x in found if len(x)]) < len(found))
+
+    def test_snapshot(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "kgld.cap.p"), "rb") as f:
+            alerts = pickle.load(f)
+        buf = MessageCache((40.321909, -102.718192), "008125", default_VTEC_sort)
+        for t, cap in alerts[:30]:
+            for v in cap.vtec:
+                buf.add_message(v)
+        same = SAMEMessage("WXL58", "-WXR-SVR-008125+0100-1460000-KGLD/NWS-")
+        buf.add_message(same)
+        t = alerts[29][0]
+
+        def summarize(cache, when):
+            return list([[(g.get_event_id(), list([str(m) for m in g.messages])) for g in
+                          cache.get_active_messages(when, here=here)] for here in (True, False)])
+
+        with tempfile.TemporaryDirectory() as d:
+            filename = os.path.join(d, "cache.snapshot")
+            self.assertIsNone(read_snapshot(filename))
+            writer = SnapshotWriter(buf, filename, 3600)
+            writer.close()  # which writes it
+            snapshot = read_snapshot(filename)
+
+            with gzip.open(filename, "rb") as f:
+                d = json.loads(f.read().decode("UTF-8"))
+            d["version"] += 1
+            with gzip.open(filename, "wb") as f:
+                f.write(json.dumps(d).encode("UTF-8"))
+            self.assertRaises(ValueError, read_snapshot, filename)
+
+        restored = MessageCache((40.321909, -102.718192), "008125", default_VTEC_sort)
+        self.assertTrue(0 < restored.restore(snapshot, t) < len(snapshot["messages"]))  # without the ended ones
+        self.assertEqual([str(same)], list([str(m) for g in restored.get_active_messages(same.get_start_time_sec())
+                                            for m in g.messages]))
+        for when in range(t, t + 86400, 600):
+            self.assertEqual(summarize(buf, when), summarize(restored, when))
+        self.assertTrue(len(summarize(restored, t)[0]) > 0)
+
+        # Nothing that had ended is restored
+        restored = MessageCache((40.321909, -102.718192), "008125", default_VTEC_sort)
+        self.assertEqual(0, restored.restore(snapshot, same.get_end_time_sec()))
+        self.assertEqual([], restored.snapshot()["messages"])
+
+    def test_stats(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "kgld.cap.p"), "rb") as f:
+            alerts = pickle.load(f)
+        buf = MessageCache((40.321909, -102.718192), "008125", default_VTEC_sort)
+        for t, cap in alerts:
+            for v in cap.vtec:
+                buf.add_message(v)
+        buf.add_message(alerts[0][1].vtec[0])
+        n = sum([len(cap.vtec) for t, cap in alerts])
+        t = alerts[-1][0]
+        results = list([len(buf.get_active_messages(t + 600 * i)) for i in range(0, 10)])
+        buf.clear_inactive(t + 86400)
+
+        stats = buf.stats()
+        self.assertEqual(n + 1, stats["added"] + stats["duplicates"])
+        self.assertTrue(stats["duplicates"] >= 1)
+        self.assertEqual(10, stats["queries"])  # not counting clear_inactive's own
+        self.assertEqual(len(set([v.event_id for t, cap in alerts for v in cap.vtec])), stats["evicted"])
+        self.assertEqual(n + 2, stats["lock_wait_seconds"]["count"])
+        self.assertEqual(10, stats["query_seconds"]["count"])
+        self.assertEqual((float("inf"), 10), stats["query_results"]["buckets"][-1])
+        self.assertEqual(sum(results), stats["query_results"]["sum"])
+        for bound, count in stats["query_results"]["buckets"]:
+            self.assertEqual(len([x for x in results if x <= bound]), count)
+        buf.snapshot(t)
+        self.assertEqual(n + 3, buf.stats()["lock_wait_seconds"]["count"])
+
+        text = to_prometheus(stats, "rpinwr_messagecache")
+        self.assertIn("# TYPE rpinwr_messagecache_added_total counter\nrpinwr_messagecache_added_total %d\n" %
+                      stats["added"], text)
+        self.assertIn('rpinwr_messagecache_query_results_bucket{le="+Inf"} 10\n', text)
+        self.assertIn('rpinwr_messagecache_query_results_bucket{le="1"} %d\n' %
+                      len([x for x in results if x <= 1]), text)
+        self.assertIn("rpinwr_messagecache_query_seconds_count 10\n", text)
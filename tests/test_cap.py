@@ -62,3 +62,16 @@ class TestCAP(unittest.TestCase):
         self.assertEqual(1464049200.0, cm.get_end_time_sec())
         self.assertTrue(cm.polygon.contains(Point(29.6011519, -98.0439125)))
         self.assertFalse(cm.polygon.contains(Point(29.582935, -97.969713)))
+
+    def test_applies_to_fips(self):
+        cm = CAP.CAPMessage(TestCAP._get_test_messages()[0])
+        self.assertEqual(['020109', '020199'], cm.FIPS6)
+        self.assertTrue(cm.applies_to_fips('020109'))
+        self.assertTrue(cm.applies_to_fips('120109'))  # part of a county named in whole
+        self.assertFalse(cm.applies_to_fips('020110'))
+
+        cm.FIPS6 = ['120109']
+        del cm._CAPMessage__fips  # as if unpickled from before the codes were indexed
+        self.assertTrue(cm.applies_to_fips('020109'))  # the whole county includes the part
+        self.assertTrue(cm.applies_to_fips('120109'))
+        self.assertFalse(cm.applies_to_fips('220109'))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+__author__ = 'ke4roh'
+# Tests for handling of incoming messages and the likes
+# Copyright © 2016 James E. Scarborough
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+import json
+import os
+import tempfile
+import time
+from RPiNWR.SAME import average_message, SAMEMessage
+import RPiNWR.same_batch as same_batch
+
+
+class TestSAMEBatch(unittest.TestCase):
+    @staticmethod
+    def _load_dirty_messages():
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "dirty_messages.json"), "r",
+                  encoding='UTF-8') as f:
+            return json.load(f)
+
+    def test_batch_matches_average_message(self):
+        messages = self._load_dirty_messages()
+        with tempfile.TemporaryDirectory() as d:
+            infile = os.path.join(d, "headers.jsonl")
+            outfile = os.path.join(d, "decoded.jsonl")
+            with open(infile, "w", encoding='UTF-8') as f:
+                for msg in messages:
+                    f.write(json.dumps({"headers": msg["headers"], "time": msg["headers"][0][2]}) + "\n")
+                f.write("\n")
+                f.write('{"headers": []}\n')  # can't be decoded
+
+            same_batch.main([infile, "--output", outfile, "--transmitter", "WXL58", "--processes", "2",
+                             "--chunksize", "3"])
+
+            with open(outfile, "r", encoding='UTF-8') as f:
+                decoded = [json.loads(x) for x in f]
+
+        self.assertEqual(len(messages) + 1, len(decoded))
+        for msg, result in zip(messages, decoded):
+            expected, confidence = average_message(msg["headers"], msg["transmitter"])
+            self.assertEqual(expected, result["message"])
+            self.assertEqual(confidence, result["confidence"])
+            self.assertEqual("WXL58", result["transmitter"])
+            self.assertTrue(result["decode_sec"] >= 0)
+        self.assertTrue("error" in decoded[-1])
+
+    def test_batch_of_to_dict(self):
+        messages = self._load_dirty_messages()[0:4]
+        with tempfile.TemporaryDirectory() as d:
+            infile = os.path.join(d, "headers.jsonl")
+            outfile = os.path.join(d, "decoded.jsonl")
+            with open(infile, "w", encoding='UTF-8') as f:
+                for msg in messages:
+                    # As recorded from a radio that didn't know its transmitter
+                    record = SAMEMessage(None, [tuple(h) for h in msg["headers"]]).to_dict()
+                    self.assertIsNone(record["transmitter"])
+                    f.write(json.dumps(record) + "\n")
+
+            same_batch.main([infile, "--output", outfile, "--transmitter", "WXL58", "--processes", "1"])
+
+            with open(outfile, "r", encoding='UTF-8') as f:
+                decoded = [json.loads(x) for x in f]
+
+        self.assertEqual(len(messages), len(decoded))
+        for msg, result in zip(messages, decoded):
+            self.assertEqual(average_message(msg["headers"], "WXL58")[0], result["message"])
+            self.assertEqual("WXL58", result["transmitter"])
+
+    def test_streaming(self):
+        # A long recording isn't read all at once
+        msg = self._load_dirty_messages()[0]
+        line = json.dumps({"headers": msg["headers"], "transmitter": msg["transmitter"]})
+        read = []
+
+        def lines():
+            for i in range(2000):
+                read.append(i)
+                yield line
+
+        decoded = same_batch.decode_all(lines(), processes=2, chunksize=4)
+        self.assertEqual(average_message(msg["headers"], msg["transmitter"])[0], json.loads(next(decoded))["message"])
+        time.sleep(.2)
+        self.assertTrue(len(read) <= 2 * 2 * 4 * 4, len(read))  # two windows
+        self.assertEqual(1999, sum(1 for x in decoded))
+        self.assertEqual(2000, len(read))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,7 +18,7 @@ __author__ = 'ke4roh'
 import unittest
 from RPiNWR.VTEC import *
 import pickle
-from RPiNWR.cache import EventMessageGroup
+from RPiNWR.cache import EventMessageGroup, MessageCache
 import os
 
 
@@ -89,6 +89,63 @@ class TestVTEC(unittest.TestCase):
         self.assertTrue(container.is_effective(ll, fips, True, container.messages[0].get_start_time_sec()))
         self.assertFalse(container.is_effective(ll, fips, True, container.messages[1].published))
 
+    def test_effective_message(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "kddc.cap.p"), "rb") as f:
+            alerts = pickle.load(f)
+        vv = list(filter(lambda v: v.event_id == "KDDC.TO.W.0052",
+                         [item for sublist in [c.vtec for a, c in alerts] for item in sublist]))
+        fips = "020047"
+
+        # Ask about the county before the updates arrive, then see that they're taken into account
+        container = EventMessageGroup()
+        container.add_message(vv[0])
+        self.assertIs(vv[0], container.get_effective_message(fips, vv[0].get_start_time_sec()))
+        self.assertIsNone(container.get_effective_message(fips, vv[0].published - 1))
+        container.add_messages(vv[1:])
+        for t in sorted(set([v.published for v in vv])):
+            expected = [v for v in container.messages if v.applies_to_fips(fips) and v.published <= t][-1]
+            self.assertIs(expected, container.get_effective_message(fips, t + 1))
+        self.assertIsNone(container.get_effective_message(fips, container.get_end_time_sec()))
+        self.assertIsNone(container.get_effective_message("020001", vv[0].get_start_time_sec()))
+
+    def test_open_ended(self):
+        class Container(object):  # just enough of a CAPMessage
+            polygon = None
+
+            def __init__(self, published):
+                self.published = published
+
+            def get_start_time_sec(self):
+                return self.published
+
+            def get_areas(self):
+                return ["048201"]
+
+            def applies_to_fips(self, fips):
+                return fips == "048201"
+
+        vv = list([VTEC.VTEC(v, Container(p))[0] for v, p in [
+            ('/O.NEW.KHGX.FL.W.0133.160520T2325Z-000000T0000Z/', 1463786700),
+            ('/O.CON.KHGX.FL.W.0133.000000T0000Z-000000T0000Z/', 1463800000),
+            ('/O.CAN.KHGX.FL.W.0133.000000T0000Z-160522T1325Z/', 1463900000)]])
+        self.assertIsNone(vv[0].get_end_time_sec())
+
+        container = EventMessageGroup()
+        container.add_message(vv[0])
+        self.assertTrue(container.is_effective(None, "048201", True, 1463790000))
+        self.assertIs(vv[0], container.get_effective_message("048201", 1e10))  # until further notice
+        container.add_message(vv[1])
+        self.assertIs(vv[1], container.get_effective_message("048201", 1463800001))
+        container.add_message(vv[2])
+        self.assertIs(vv[2], container.get_effective_message("048201", 1463900001))
+        self.assertIsNone(container.get_effective_message("048201", 1463786000))
+        self.assertTrue(container.is_effective(None, "048201", True, 1463900001))
+
+        cache = MessageCache(None, "048201", default_VTEC_sort)
+        for v in vv:
+            cache.add_message(v)
+        self.assertEqual(1, len(cache.get_active_messages(1463900001)))
+
     def test_applicable(self):
         ll = (40.321909, -102.718192)
         fips = "008125"